@@ -0,0 +1,83 @@
+import argparse
+import tracemalloc
+import numpy as np
+
+from preprocessing import calibrate_img, calibrate_img_advanced, l1_normalize, smooth_spectral, to_absorbance, normalize_spectral_interval
+
+
+def peak_allocation(func, *args, **kwargs):
+    '''
+    Returns the peak memory in bytes allocated while running func(*args, **kwargs), measured with tracemalloc.
+    Buffers that exist before the call (inputs, preallocated out= buffers) are not counted.
+    '''
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def allocating_chain(img, white_ref, dark_ref):
+    # every step returns a new cube, like the chain in the notebooks
+    img_calib = calibrate_img(img, white_ref, dark_ref)
+    img_norm = l1_normalize(img_calib)
+    img_smooth = smooth_spectral(img_norm, 5)
+    return to_absorbance(img_smooth)
+
+
+def inplace_chain(img, white_ref, dark_ref, buffer, scratch):
+    # one buffer and one scratch buffer for the whole chain
+    calibrate_img(img, white_ref, dark_ref, out=buffer)
+    l1_normalize(buffer, inplace=True)
+    smooth_spectral(buffer, 5, out=scratch)
+    return to_absorbance(scratch, inplace=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak allocations of the preprocessing functions with new outputs vs. out=/inplace buffers")
+    parser.add_argument("--shape", nargs=3, type=int, default=[256, 256, 381], help="Shape of the synthetic cube (m, l, k)")
+    args = parser.parse_args()
+
+    m, l, k = args.shape
+    rng = np.random.default_rng(0)
+    img = rng.uniform(100, 1000, (m, l, k)).astype(np.float32)
+    white_ref = rng.uniform(2000, 3000, (1, l, k)).astype(np.float32)
+    dark_ref = rng.uniform(10, 50, (1, l, k)).astype(np.float32)
+    reflectance = img / 1000
+    buffer = np.empty_like(img)
+    scratch = np.empty_like(img)
+
+    cases = [
+        ("calibrate_img",
+         lambda: calibrate_img(img, white_ref, dark_ref),
+         lambda: calibrate_img(img, white_ref, dark_ref, out=buffer)),
+        ("calibrate_img_advanced",
+         lambda: calibrate_img_advanced(img, white_ref, dark_ref),
+         lambda: calibrate_img_advanced(img, white_ref, dark_ref, out=buffer)),
+        ("l1_normalize",
+         lambda: l1_normalize(reflectance),
+         lambda: l1_normalize(reflectance, out=buffer)),
+        ("to_absorbance",
+         lambda: to_absorbance(reflectance),
+         lambda: to_absorbance(reflectance, out=buffer)),
+        ("normalize_spectral_interval",
+         lambda: normalize_spectral_interval(reflectance),
+         lambda: normalize_spectral_interval(reflectance, out=buffer)),
+        ("chain (calibrate, l1, smooth, -log)",
+         lambda: allocating_chain(img, white_ref, dark_ref),
+         lambda: inplace_chain(img, white_ref, dark_ref, buffer, scratch)),
+    ]
+
+    cube_mb = img.nbytes / 2**20
+    print(f"cube shape {tuple(args.shape)}, {cube_mb:.1f} MB as float32")
+    print(f"{'function':<38}{'new output':>12}{'out=':>12}{'saved':>12}")
+    for name, allocating, buffered in cases:
+        peak_alloc = peak_allocation(allocating) / 2**20
+        peak_buffered = peak_allocation(buffered) / 2**20
+        print(f"{name:<38}{peak_alloc:>9.1f} MB{peak_buffered:>9.1f} MB{peak_alloc - peak_buffered:>9.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import csv
+import json
+import time
+import argparse
+import traceback
+import spectral as sp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from preprocessing import PreprocessingPipeline
+from product_cache import envi_files
+
+INPUT_FILES = ["raw.hdr", "whiteReference.hdr", "darkReference.hdr"]
+
+
+def input_paths(patient_folder):
+    '''
+    Returns the ENVI header and data files the preprocessing of a patient depends on.
+    '''
+    return [path for hdr in INPUT_FILES for path in envi_files(os.path.join(patient_folder, hdr))]
+
+
+def is_up_to_date(patient_folder, output, params):
+    '''
+    Checks if the output of a patient exists, is newer than all its inputs and was produced with the same parameters.
+    '''
+    output_file = os.path.join(patient_folder, output)
+    meta_file = os.path.splitext(output_file)[0] + ".json"
+    if not (os.path.exists(output_file) and os.path.exists(meta_file)):
+        return False
+    with open(meta_file) as f:
+        if json.load(f) != params:
+            return False
+    output_time = os.path.getmtime(output_file)
+    return all(os.path.getmtime(path) <= output_time for path in input_paths(patient_folder))
+
+
+def process_patient(patient_folder, output, params, tile_rows=32):
+    '''
+    Preprocess one patient with PreprocessingPipeline. The output is written to a temporary file first
+    and only renamed when complete, so an interrupted run never leaves an output that looks up to date.
+    output:
+        per-stage timings in seconds, dict
+    '''
+    img = sp.open_image(os.path.join(patient_folder, "raw.hdr"))
+    white_ref = sp.open_image(os.path.join(patient_folder, "whiteReference.hdr"))
+    dark_ref = sp.open_image(os.path.join(patient_folder, "darkReference.hdr"))
+
+    pipeline = PreprocessingPipeline(params["bands_range"], params["window_size"], tile_rows)
+    output_file = os.path.join(patient_folder, output)
+    tmp_file = output_file + ".tmp"
+    absorbance, _ = pipeline.run(img, white_ref, dark_ref, out=tmp_file)
+    del absorbance
+    os.replace(tmp_file, output_file)
+    with open(os.path.splitext(output_file)[0] + ".json", "w") as f:
+        json.dump(params, f)
+    return pipeline.timings
+
+
+def read_summary(summary_file):
+    '''
+    Returns the rows of an existing timing summary keyed by patient, empty if there is none.
+    '''
+    if not os.path.exists(summary_file):
+        return {}
+    with open(summary_file, newline="") as f:
+        return {row["patient"]: row for row in csv.DictReader(f)}
+
+
+def write_summary(summary_file, rows, previous=None):
+    '''
+    Writes the timing summary. Rows of patients that were not processed in this run (up to date or not selected)
+    keep their row from the previous summary, so a partial rerun does not lose earlier timings.
+    '''
+    fields = ["patient", "status"] + PreprocessingPipeline.stages + ["total", "error"]
+    merged = dict(previous or {})
+    for row in rows:
+        if row["status"] != "up to date" or row["patient"] not in merged:
+            merged[row["patient"]] = row
+    tmp_file = summary_file + ".tmp"
+    with open(tmp_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for patient in sorted(merged):
+            writer.writerow(merged[patient])
+    os.replace(tmp_file, summary_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess all patients of a dataset from raw ENVI cubes to absorbance in parallel")
+    parser.add_argument("--data_dir", type=str, required=True, help="Dataset folder with one subfolder per patient, e.g. ../datasets/npj_database")
+    parser.add_argument("--patients", nargs='+', type=str, default=None, help="Patients to process, default all")
+    parser.add_argument("--output", type=str, default="preprocessed.npy", help="Name of the output file in each patient folder")
+    parser.add_argument("--bands_range", nargs=2, type=int, default=[520, 900], help="Band range to interpolate to")
+    parser.add_argument("--window_size", type=int, default=5, help="Spectral smoothing window")
+    parser.add_argument("--tile_rows", type=int, default=32, help="Rows per tile within one cube")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--max_in_flight", type=int, default=4, help="Maximum number of cubes processed at the same time, caps memory")
+    parser.add_argument("--force", action="store_true", help="Reprocess patients whose outputs are up to date")
+    parser.add_argument("--summary", type=str, default=None, help="CSV file for the per-patient timing summary, default <data_dir>/preprocessing_summary.csv")
+    args = parser.parse_args()
+
+    # only parameters that change the output, the tile size does not
+    params = {"bands_range": args.bands_range, "window_size": args.window_size}
+    patients = args.patients if args.patients is not None else sorted(os.listdir(args.data_dir))
+    summary_file = args.summary or os.path.join(args.data_dir, "preprocessing_summary.csv")
+    previous = read_summary(summary_file)
+
+    rows = []
+    todo = []
+    for patient in patients:
+        folder = os.path.join(args.data_dir, patient)
+        if not os.path.exists(os.path.join(folder, "raw.hdr")):
+            continue
+        if not args.force and is_up_to_date(folder, args.output, params):
+            rows.append({"patient": patient, "status": "up to date"})
+        else:
+            todo.append(patient)
+    print(f"{len(todo)} patients to process, {len(rows)} up to date")
+
+    n_workers = max(1, min(args.workers, args.max_in_flight))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        running = {}
+        queue = list(todo)
+        while queue or running:
+            # only submit new cubes when a slot is free, so at most max_in_flight cubes are in memory
+            while queue and len(running) < n_workers:
+                patient = queue.pop(0)
+                future = executor.submit(process_patient, os.path.join(args.data_dir, patient), args.output, params, args.tile_rows)
+                running[future] = (patient, time.perf_counter())
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                patient, t0 = running.pop(future)
+                row = {"patient": patient, "total": round(time.perf_counter() - t0, 3)}
+                try:
+                    timings = future.result()
+                    row.update({stage: round(seconds, 3) for stage, seconds in timings.items()})
+                    row["status"] = "done"
+                    print(f"{patient}: done in {row['total']:.1f} s")
+                except Exception:
+                    row["status"] = "failed"
+                    row["error"] = traceback.format_exc().strip().splitlines()[-1]
+                    print(f"{patient}: failed ({row['error']})")
+                rows.append(row)
+                # keep the summary current, so it is available even if the run is interrupted
+                write_summary(summary_file, rows, previous)
+    write_summary(summary_file, rows, previous)
+
+
+if __name__ == "__main__":
+    main()
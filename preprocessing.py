@@ -1,32 +1,311 @@
 import torch
 import numpy as np
 import spectral as sp
+import time
 import scipy
+import scipy.linalg
+from functools import lru_cache
 from scipy.ndimage import convolve1d
 from pysptools.detection.detect import CEM
 
-def get_array(img):
+def _subset_index(ndim, bands=None, rows=None, cols=None):
+    '''
+    Builds the index selecting rows, columns and bands of an array of shape (m,l,...,k).
+    '''
+    if rows is None and cols is None:
+        return (Ellipsis, slice(None) if bands is None else bands)
+    if ndim < 3:
+        raise ValueError("rows and cols can only be selected for images of shape (m,l,k)")
+    rows = slice(None) if rows is None else slice(*rows)
+    cols = slice(None) if cols is None else slice(*cols)
+    return (rows, cols, Ellipsis, slice(None) if bands is None else bands)
+
+def _check_out(out, shape):
+    '''
+    Checks that an out= buffer can hold the result of a function.
+    '''
+    if out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous float32 array")
+    if out.shape != tuple(shape):
+        raise ValueError(f"out has shape {out.shape}, expected {tuple(shape)}")
+    return out
+
+def _read_spyfile(img, bands=None, rows=None, cols=None, out=None):
+    '''
+    Reads the selected part of a SpyFile as float32 through its memory map, so only the selected bands, rows and columns are loaded.
+    '''
+    if not img.using_memmap:
+        row_bounds = (0, img.nrows) if rows is None else rows
+        col_bounds = (0, img.ncols) if cols is None else cols
+        band_idx = None if bands is None else np.arange(img.nbands)[bands].tolist()
+        arr = img.read_subregion(row_bounds, col_bounds, band_idx)
+        if out is None:
+            return arr.astype(np.float32)
+        _check_out(out, arr.shape)[...] = arr
+        return out
+    # memmap view with shape (rows, cols, bands), slicing does not read any data yet
+    view = img.open_memmap(interleave='bip')[_subset_index(3, bands, rows, cols)]
+    # a single copy converts to float32 and reorders the interleave of the file to C order
+    arr = np.empty(view.shape, dtype=np.float32) if out is None else _check_out(out, view.shape)
+    arr[...] = view
+    return arr
+
+def get_array(img, bands=None, rows=None, cols=None, out=None, inplace=False):
     '''
     Returns the image as a numpy array.
+    Optionally only a band subset and/or a row/column ROI is returned. SpyFiles are then read
+    through a memory map, so only the selected part is loaded and converted to float32.
     input:
         img: image to convert, SpyFile or array-like
+        bands: bands to keep, slice, index array or boolean mask (optional)
+        rows: row bounds (start, stop) to keep, only for images of shape (m,l,k) (optional)
+        cols: column bounds (start, stop) to keep, only for images of shape (m,l,k) (optional)
+        out: C-contiguous float32 array the result is written to (optional)
+        inplace: if True, a C-contiguous float32 array is returned as is instead of copied
     output:
         image as numpy array as float32
     '''
-    if isinstance(img, np.ndarray):
-        return img.astype(np.float32)
-    if isinstance(img, sp.io.bilfile.BilFile):
-        img = img.asarray().astype(np.float32)
-    else:
+    if out is not None and out is img:
+        return _check_out(out, img.shape)
+    if isinstance(img, sp.io.spyfile.SpyFile):
+        return _read_spyfile(img, bands, rows, cols, out)
+    if not isinstance(img, np.ndarray):
         try:
-            img = np.asarray(img).astype(np.float32)
+            img = np.asarray(img)
         except:
             raise ValueError("Unsupported input type")
+    if bands is not None or rows is not None or cols is not None:
+        img = img[_subset_index(img.ndim, bands, rows, cols)]
+    if out is not None:
+        np.copyto(_check_out(out, img.shape), img, casting='unsafe')
+        return out
+    if inplace and img.dtype == np.float32 and img.flags.c_contiguous:
+        return img
+    try:
+        img = img.astype(np.float32)
+    except:
+        raise ValueError("Unsupported input type")
     return img
 
+def _pixel_chunks(img, chunk_size=2048):
+    '''
+    Yields views of consecutive chunks of pixels of a C-contiguous image, each of shape (n,k).
+    '''
+    X = img.reshape(-1, img.shape[-1])
+    for p0 in range(0, X.shape[0], chunk_size):
+        yield X[p0:p0 + chunk_size]
+
+class OrthogonalProjector:
+    '''
+    Projection onto the subspace orthogonal to a set of spectra (illumination, endmembers), stored as an orthonormal
+    basis U (k, r) of the removed subspace instead of the dense k x k matrix I - U U^T. Applying it costs O(k*r) per pixel
+    as x - U (U^T x). Projectors compose by stacking their bases, so illumination and endmember removal can be combined
+    without forming a k x k matrix.
+
+    usage:
+        projector = OrthogonalProjector.from_vectors(endmembers_proj)          # (n, k)
+        abs_proj = projector.compose(OrthogonalProjector.from_vectors(E)).apply(abs)
+    '''
+    def __init__(self, basis):
+        self.basis = np.asarray(basis, dtype=np.float64)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_bands={self.basis.shape[0]}, rank={self.rank})"
+
+    @property
+    def rank(self):
+        return self.basis.shape[1]
+
+    @classmethod
+    def from_vectors(cls, vectors, rtol=None):
+        '''
+        Builds the projector removing the span of the given spectra, the basis is computed with a QR decomposition
+        with column pivoting, directions with |R_ii| <= rtol * |R_00| (linearly dependent spectra) are dropped.
+        input:
+            vectors: spectra to remove, shape (k,) or (n, k)
+            rtol: relative rank tolerance, default max(n,k) * eps
+        output:
+            OrthogonalProjector
+        '''
+        A = np.atleast_2d(np.asarray(vectors, dtype=np.float64)).T
+        if A.shape[1] == 0:
+            return cls(np.zeros((A.shape[0], 0)))
+        Q, R, _ = scipy.linalg.qr(A, mode='economic', pivoting=True)
+        rtol = max(A.shape) * np.finfo(np.float64).eps if rtol is None else rtol
+        diag = np.abs(np.diag(R))
+        rank = int(np.sum(diag > rtol * diag[0])) if diag[0] > 0 else 0
+        return cls(Q[:, :rank])
+
+    def compose(self, other):
+        '''
+        Projector removing the subspaces of both projectors (the orthogonal complement of their sum),
+        the same as applying both one after another if the subspaces are orthogonal.
+        '''
+        return OrthogonalProjector.from_vectors(np.concatenate((self.basis, other.basis), axis=1).T)
+
+    def apply(self, x, out=None):
+        '''
+        Projects spectra onto the subspace orthogonal to the removed spectra.
+        input:
+            x: spectra, np.array or torch tensor of shape (...,k)
+            out: float32 np.array of the shape of x the result is written to, may be x itself (optional)
+        output:
+            projected spectra, same type as x
+        '''
+        if isinstance(x, torch.Tensor):
+            U = torch.from_numpy(self.basis).to(device=x.device, dtype=x.dtype)
+            return x - (x @ U) @ U.T
+        x = np.asarray(x)
+        U = self.basis.astype(np.result_type(x.dtype, np.float32))
+        coeffs = x @ U
+        if out is None:
+            return x - coeffs @ U.T
+        if out is not x:
+            out[...] = x
+        out -= coeffs @ U.T
+        return out
+
+class ReferenceModel:
+    '''
+    Illumination/reference model of one acquisition session, built once from the white and dark reference
+    and shared by all images of that session. Holds the dark frame, the illumination spectrum E averaged over
+    the reference pixels (as in calibrate_img), the smoothed illumination spectrum and the projector onto the
+    subspace orthogonal to it (as in project_img).
+    If the model is built with a bands_range, raw cubes are interpolated to 1nm steps on the fly, so calibrating
+    or projecting a further cube is a single streaming pass over its rows.
+
+    usage:
+        reference = ReferenceModel.from_references(white_ref, dark_ref, bands_old=img.bands.centers, bands_range=[520,900])
+        reference.save(data_folder + "/reference_model.npz")
+        img_calib = reference.calibrate(img)
+    '''
+    def __init__(self, dark, E, window_size=5, plan=None, band_slice=None):
+        self.dark = dark
+        self.E = E
+        self.window_size = window_size
+        self.plan = plan
+        self.band_slice = band_slice
+        self.bands = None if plan is None else plan[2]
+        # smoothed illumination spectrum and projector used by project_img
+        self.E_smooth = smooth_spectral(E.squeeze(), window_size)
+        self.projector = OrthogonalProjector.from_vectors(self.E_smooth)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(nbands={self.E.shape[-1]}, window_size={self.window_size}, interpolated={self.plan is not None})"
+
+    @classmethod
+    def from_references(cls, white_ref, dark_ref, window_size=5, bands_old=None, bands_range=None):
+        '''
+        Build the model from the white and dark reference.
+        input:
+            white_ref: white reference, SpyFile or array of shape (...,k)
+            dark_ref: dark reference, SpyFile or array of shape (...,k)
+            window_size: smoothing window of the illumination spectrum used for the projection, int
+            bands_old: band centers of the references and raw images, needed for bands_range if the references are not SpyFiles
+            bands_range: if given, references and images are interpolated to 1nm steps in this range, list containing min and max band
+        output:
+            ReferenceModel
+        '''
+        plan, band_slice = None, None
+        if bands_range is not None:
+            if isinstance(white_ref, sp.io.spyfile.SpyFile):
+                bands_old = white_ref.bands.centers
+            if bands_old is None:
+                raise ValueError("bands_old must be provided when the references are not SpyFiles")
+            band_slice, plan = _plan_band_subset(get_interpolation_plan(bands_old, bands_range))
+            white_ref = apply_interpolation_plan(get_array(white_ref, bands=band_slice), plan)
+            dark_ref = apply_interpolation_plan(get_array(dark_ref, bands=band_slice), plan)
+        else:
+            white_ref, dark_ref = get_array(white_ref), get_array(dark_ref)
+        # first subract dark reference from white reference pixel-wise to get rid of pixel differences, then average over pixels to minimize noise
+        E = np.mean(np.subtract(white_ref, dark_ref, dtype=np.float32), axis=-2, keepdims=True)
+        return cls(dark_ref, E, window_size, plan, band_slice)
+
+    def read(self, img, rows=None):
+        '''
+        Reads (the rows of) an image on the band grid of the model, interpolating raw cubes if the model has a bands_range.
+        '''
+        if self.plan is None:
+            return get_array(img, rows=rows)
+        return apply_interpolation_plan(get_array(img, bands=self.band_slice, rows=rows), self.plan)
+
+    def calibrate_tile(self, tile, r0=0, r1=None):
+        '''
+        Calibrate a float32 tile holding the rows r0 to r1-1 of an image in place.
+        '''
+        r1 = r0 + tile.shape[0] if r1 is None else r1
+        tile -= _ref_rows(self.dark, r0, r1)
+        tile /= _ref_rows(self.E, r0, r1)
+        return tile
+
+    def _stream(self, img, out, tile_rows, func):
+        '''
+        Applies func(tile, r0, r1) to row tiles of img and writes the results into out.
+        '''
+        if len(img.shape) < 3:
+            return func(self.read(img), 0, None)
+        shape = tuple(img.shape[:-1]) + (self.E.shape[-1],)
+        out = _open_output(out, shape)
+        for r0, r1 in _row_tiles(shape[0], tile_rows):
+            out[r0:r1] = func(self.read(img, rows=(r0, r1)), r0, r1)
+        return out
+
+    def calibrate(self, img, out=None, tile_rows=64):
+        '''
+        Calibrate an image of this session in one streaming pass, same result as calibrate_img.
+        input:
+            img: image to calibrate, SpyFile or array of shape (m,l,k), raw bands if the model has a bands_range
+            out: None, path of a .npy file to memory-map, or preallocated float32 array
+            tile_rows: number of rows per tile, int
+        output:
+            calibrated image as np.array
+        '''
+        return self._stream(img, out, tile_rows, self.calibrate_tile)
+
+    def project(self, img, out=None, tile_rows=64, device="cpu"):
+        '''
+        Project the dark-corrected image onto the subspace orthogonal to the illumination spectrum in one streaming pass,
+        same result as project_img.
+        input:
+            img: image to project, SpyFile or array of shape (m,l,k), raw bands if the model has a bands_range
+            out: None, path of a .npy file to memory-map, or preallocated float32 array
+            tile_rows: number of rows per tile, int
+        output:
+            projected image as np.array
+        '''
+        def project(tile, r0, r1):
+            r1 = r0 + tile.shape[0] if r1 is None else r1
+            R = torch.from_numpy(tile - _ref_rows(self.dark, r0, r1)).to(device).float()
+            return self.projector.apply(R).cpu().numpy()
+        return self._stream(img, out, tile_rows, project)
+
+    def save(self, path):
+        '''
+        Save the model to a .npz file.
+        '''
+        interp = {}
+        if self.plan is not None:
+            interp = {"idx": self.plan[0], "weights": self.plan[1], "bands": self.plan[2],
+                      "band_slice": np.array([self.band_slice.start, self.band_slice.stop])}
+        np.savez(path, dark=self.dark, E=self.E, window_size=self.window_size, E_smooth=self.E_smooth,
+                 projector_basis=self.projector.basis, **interp)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a model saved with save.
+        '''
+        data = np.load(path)
+        plan, band_slice = None, None
+        if "idx" in data:
+            plan = (data["idx"], data["weights"], data["bands"])
+            band_slice = slice(*data["band_slice"].tolist())
+        return cls(data["dark"], data["E"], int(data["window_size"]), plan, band_slice)
+
 def project_img(img, white_ref, dark_ref, device="cpu"):
     '''
     Project the image onto the subspace orthogonal to the illumination spectrum.
+    To project several images of the same session, build a ReferenceModel once and use ReferenceModel.project.
     input:
         img: image to project, shape (...,k) where k is the number of bands and ... are the spatial or time dimensions
         white_ref: white reference, shape (...,k) where m is the number of white reference pixels
@@ -34,27 +313,7 @@ def project_img(img, white_ref, dark_ref, device="cpu"):
     output:
         projected image as np.array
     '''
-    img, white_ref, dark_ref = get_array(img), get_array(white_ref), get_array(dark_ref)
-    # calculate reflectance
-    R = np.subtract(img, dark_ref, dtype=np.float32)
-    # calculate illumination spectrum E
-    E = np.mean(np.subtract(white_ref, dark_ref, dtype=np.float32), axis=-2).squeeze()
-    E = smooth_spectral(E, 5)
-    # get mapping to subspace orthogonal to E
-    P_E = np.eye(E.shape[0]) - np.outer(E, E)/np.dot(E, E)
-    
-    # apply mapping to data
-    # create torch tensors and move to gpu
-    R = torch.from_numpy(R).to(device).float()
-    P_E = torch.from_numpy(P_E).to(device).float()
-
-    # R_E = np.einsum('ij,klj->kli', P_E, R)
-    R_E = torch.einsum('ij,...j->...i', P_E, R) 
-
-    # convert back to numpy array
-    R_E = R_E.cpu().numpy()
-
-    return R_E
+    return ReferenceModel.from_references(white_ref, dark_ref).project(img, device=device)
 
 def project_absorbance(abs, endmembers_proj, endmembers_unmix, device="cpu"):
     '''
@@ -66,14 +325,13 @@ def project_absorbance(abs, endmembers_proj, endmembers_unmix, device="cpu"):
         projected absorbance array perpendicular to all spectra, np.array
         projected endmembers_unmix, np.array
     '''
-    P = np.eye(endmembers_proj.shape[1]) - endmembers_proj.T @ np.linalg.pinv(endmembers_proj).T
+    projector = OrthogonalProjector.from_vectors(endmembers_proj)
     # convert to torch tensors
-    P = torch.from_numpy(P).to(device).float()
     abs = torch.from_numpy(abs).to(device).float()
     endmembers_unmix = torch.from_numpy(endmembers_unmix).to(device).float()
     # project data
-    abs_proj = torch.einsum('ik,...k->...i', P, abs).cpu().numpy()
-    endmembers_unmix_proj = torch.einsum('ik,nk->ni', P, endmembers_unmix).cpu().numpy()
+    abs_proj = projector.apply(abs).cpu().numpy()
+    endmembers_unmix_proj = projector.apply(endmembers_unmix).cpu().numpy()
     return abs_proj, endmembers_unmix_proj
 
 def osp(abs, endmembers_proj, endmember_target, device="cpu"):
@@ -92,10 +350,9 @@ def osp(abs, endmembers_proj, endmember_target, device="cpu"):
     endmembers_proj = torch.tensor(endmembers_proj, device=device).float()
     endmember_target = torch.tensor(endmember_target, device=device).float()
 
-    # perform OSP
-    P = torch.eye(endmembers_proj.shape[1], device=device) - endmembers_proj.T @ torch.pinverse(endmembers_proj).T
-    abs_proj = torch.einsum('ik,...k->...i', P, abs)
-    abs_proj = torch.einsum('k,...k->...', endmember_target, abs_proj)
+    # perform OSP, the projector is symmetric, so projecting the target is the same as projecting every pixel
+    target_proj = OrthogonalProjector.from_vectors(endmembers_proj.cpu().numpy()).apply(endmember_target)
+    abs_proj = torch.einsum('k,...k->...', target_proj, abs)
 
     if was_numpy:
         abs_proj = abs_proj.cpu().numpy()
@@ -135,6 +392,364 @@ def icem(spectr, t, lmda=0, R=None, device='cpu'):
 
     return y.reshape(input_shape[:-1])
 
+def leave_one_out(M):
+    '''
+    Target and endmember sets for detecting every endmember against all others, as used for the heatmaps.
+    input:
+        M: endmember spectra matrix, shape (k, n)
+    output:
+        endmembers_proj: list of n arrays of shape (n-1, k), the endmembers to remove for each target
+        targets: target spectra, shape (n, k)
+    '''
+    M = np.asarray(M)
+    return [np.delete(M, i, axis=1).T for i in range(M.shape[1])], M.T
+
+def osp_filters(endmembers_proj, targets):
+    '''
+    Filter vectors of OSP for several targets: the heatmap of target t_j is w_j^T x with w_j = P_j^T t_j, where P_j projects
+    onto the subspace orthogonal to the endmembers removed for that target.
+    input:
+        endmembers_proj: endmember spectra to remove, shape (n, k) shared by all targets, or a list with one (n_j, k) array per target
+        targets: target endmembers to detect, shape (n_targets, k)
+    output:
+        W: filter vectors, np.array of shape (n_targets, k)
+    '''
+    targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+    if not isinstance(endmembers_proj, (list, tuple)):
+        endmembers_proj = [endmembers_proj] * targets.shape[0]
+    W = np.zeros_like(targets)
+    for j, (E, t) in enumerate(zip(endmembers_proj, targets)):
+        W[j] = OrthogonalProjector.from_vectors(E).apply(t)
+    return W
+
+def icem_filters(R, targets, lmda=0):
+    '''
+    Filter vectors of (I)CEM for several targets, w_j = (R + lmda I)^-1 t_j / (t_j^T (R + lmda I)^-1 t_j).
+    input:
+        R: autocorrelation matrix, shape (k, k)
+        targets: target endmembers to detect, shape (n_targets, k)
+        lmda: regularization parameter, float
+    output:
+        W: filter vectors, np.array of shape (n_targets, k)
+    '''
+    targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+    R_hat = np.asarray(R, dtype=np.float64) + lmda * np.eye(R.shape[0])
+    Rinv_t = np.linalg.solve(R_hat, targets.T).T
+    return Rinv_t / np.sum(Rinv_t * targets, axis=1, keepdims=True)
+
+def apply_filters(spectr, W, chunk_size=1 << 16):
+    '''
+    Heatmaps of all filter vectors in a single pass over the pixels.
+    input:
+        spectr: image, shape (...,k)
+        W: filter vectors, shape (n_targets, k)
+    output:
+        heatmaps, np.array of shape (..., n_targets)
+    '''
+    spectr = np.asarray(spectr)
+    X = spectr.reshape(-1, spectr.shape[-1])
+    W_T = W.T.astype(np.float32)
+    heatmaps = np.empty((X.shape[0], W.shape[0]), dtype=np.float32)
+    for p0, p1 in _row_tiles(X.shape[0], chunk_size):
+        np.matmul(X[p0:p1].astype(np.float32, copy=False), W_T, out=heatmaps[p0:p1])
+    return heatmaps.reshape(spectr.shape[:-1] + (W.shape[0],))
+
+def osp_batched(abs, endmembers_proj, targets):
+    '''
+    OSP for several targets at once, same heatmaps as calling osp for every target.
+    input:
+        abs: absorbance array, shape (...,k)
+        endmembers_proj: endmember spectra to remove, shape (n, k) shared by all targets, or a list with one (n_j, k) array per target
+        targets: target endmembers to detect, shape (n_targets, k)
+    output:
+        heatmaps, np.array of shape (..., n_targets)
+    '''
+    return apply_filters(abs, osp_filters(endmembers_proj, targets))
+
+def icem_batched(spectr, targets, lmda=0, R=None, mask=None):
+    '''
+    ICEM for several targets at once, same heatmaps as calling icem for every target, R is inverted only once.
+    input:
+        spectr: image to unmix, shape (...,k)
+        targets: target endmembers to detect, shape (n_targets, k)
+        lmda: regularization parameter, float
+        R: autocorrelation matrix, computed from the pixels of spectr (selected by mask) if None, shape (k, k)
+        mask: pixels used for R, e.g. labels != 4 to exclude the background, bool array of shape (...) (optional)
+    output:
+        heatmaps, np.array of shape (..., n_targets)
+    '''
+    if R is None:
+        R = CorrelationAccumulator.from_spectra(spectr, mask).R
+    return apply_filters(spectr, icem_filters(R, targets, lmda))
+
+class ICEMEngine:
+    '''
+    ICEM with a cached eigendecomposition R = V diag(e) V^T of the autocorrelation matrix. (R + lmda I)^-1 is then
+    V diag(1/(e + lmda)) V^T for any lmda, so a whole grid of regularization parameters and targets costs one
+    eigendecomposition and one pass over the pixels.
+
+    usage:
+        engine = ICEMEngine.from_image(absorbance, mask=labels != 4)
+        heatmaps = engine.sweep(absorbance, M.T, lmdas=np.logspace(-3, 1, 9))   # (m, l, 9, n)
+    '''
+    def __init__(self, R):
+        self.R = np.asarray(R, dtype=np.float64)
+        self.eigvals, self.eigvecs = np.linalg.eigh(self.R)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_bands={self.R.shape[0]})"
+
+    @classmethod
+    def from_image(cls, spectr, mask=None):
+        '''
+        Engine for the autocorrelation matrix of the pixels of spectr (selected by mask).
+        '''
+        return cls(CorrelationAccumulator.from_spectra(spectr, mask).R)
+
+    def filters(self, targets, lmdas):
+        '''
+        ICEM filter vectors for every lmda and target, same as icem_filters(R, targets, lmda) for each lmda.
+        input:
+            targets: target endmembers to detect, shape (n_targets, k)
+            lmdas: regularization parameters, shape (n_lambda,)
+        output:
+            W: filter vectors, np.array of shape (n_lambda, n_targets, k)
+        '''
+        targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+        lmdas = np.atleast_1d(np.asarray(lmdas, dtype=np.float64))
+        T = targets @ self.eigvecs                                  # (n_targets, k) in the eigenbasis
+        scaled = T[None] / (self.eigvals[None, None] + lmdas[:, None, None])
+        denom = np.sum(scaled * T[None], axis=-1, keepdims=True)
+        return (scaled / denom) @ self.eigvecs.T
+
+    def sweep(self, spectr, targets, lmdas):
+        '''
+        ICEM heatmaps for a grid of regularization parameters and targets in one pass over the pixels.
+        input:
+            spectr: image, shape (...,k)
+            targets: target endmembers to detect, shape (n_targets, k)
+            lmdas: regularization parameters, shape (n_lambda,)
+        output:
+            heatmaps, np.array of shape (..., n_lambda, n_targets)
+        '''
+        W = self.filters(targets, lmdas)
+        heatmaps = apply_filters(spectr, W.reshape(-1, W.shape[-1]))
+        return heatmaps.reshape(heatmaps.shape[:-1] + W.shape[:2])
+
+def local_cem(spectr, targets, window=15, lmda=1e-3, n_components=20, mask=None):
+    '''
+    CEM with local autocorrelation matrices: for every pixel, R is the mean of x x^T over the window x window pixels around it
+    (clipped at the image border). The window matrices are built incrementally: column sums of the outer products over the
+    rows of the window are updated by adding the row that enters and removing the row that leaves, and the horizontal window
+    sums of a row are differences of their cumulative sum. The cost per pixel is independent of the window size.
+    To keep the d x d matrices small, the spectra are reduced to the n_components leading eigenvectors of the global R
+    (without centering, as R is an autocorrelation matrix).
+    Every row step holds about five float64 arrays of shape (l,d,d), i.e. 40*l*d^2 bytes, and solves l dense d x d systems.
+    With d = 20 this is 8 MB for l = 500; without reduction (d = k = 381) it is about 3 GB and ~4.6e12 flops for a 500x500 image.
+    input:
+        spectr: image, shape (m,l,k)
+        targets: target endmembers to detect, shape (k,) or (n_targets, k)
+        window: side length of the square window in pixels, int (odd)
+        lmda: regularization parameter added to the diagonal of the local R, float
+        n_components: dimension the spectra are reduced to, int, None for no reduction (only feasible for few bands)
+        mask: pixels contributing to the local R, e.g. labels != 4 to exclude the background, bool array of shape (m,l) (optional)
+    output:
+        heatmaps, np.array of shape (m,l) or (m,l,n_targets)
+    '''
+    single = np.ndim(targets) == 1
+    targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+    m, l, k = spectr.shape
+    if n_components is None:
+        basis = None
+        T = targets
+        d = k
+    else:
+        engine = ICEMEngine.from_image(spectr, mask)
+        basis = engine.eigvecs[:, ::-1][:, :n_components]
+        T = targets @ basis
+        d = basis.shape[1]
+    def reduced(row):
+        x = np.asarray(spectr[row], dtype=np.float64)
+        return x if basis is None else x @ basis
+    def weights(row):
+        return np.ones(l) if mask is None else np.asarray(mask[row], dtype=np.float64)
+
+    h = window // 2
+    col_sum = np.zeros((l, d, d))
+    col_count = np.zeros(l)
+    def add(row, sign):
+        x = reduced(row) * np.sqrt(weights(row))[:, None]
+        col_sum[...] += sign * np.einsum('jd,je->jde', x, x)
+        col_count[...] += sign * weights(row)
+    for row in range(min(h, m)):
+        add(row, 1)
+
+    heatmaps = np.zeros((m, l, targets.shape[0]), dtype=np.float32)
+    eye = lmda * np.eye(d)
+    for i in range(m):
+        if i + h < m:
+            add(i + h, 1)
+        if i - h - 1 >= 0:
+            add(i - h - 1, -1)
+        # horizontal window sums from the cumulative sums over the columns
+        cum_sum = np.concatenate((np.zeros((1, d, d)), np.cumsum(col_sum, axis=0)))
+        cum_count = np.concatenate(([0], np.cumsum(col_count)))
+        lo, hi = np.maximum(np.arange(l) - h, 0), np.minimum(np.arange(l) + h + 1, l)
+        count = cum_count[hi] - cum_count[lo]
+        R = (cum_sum[hi] - cum_sum[lo]) / np.maximum(count, 1)[:, None, None] + eye
+        Z = np.linalg.solve(R, np.broadcast_to(T.T, (l, d, T.shape[0])))     # R^-1 t per pixel, (l, d, n_targets)
+        heatmaps[i] = np.einsum('jd,jdt->jt', reduced(i), Z) / np.einsum('td,jdt->jt', T, Z)
+    return heatmaps[..., 0] if single else heatmaps
+
+def heatmap_features(absorbance, reference_spectrum, M_lit, M_mc, lmda=1, labels=None, folder=None):
+    '''
+    The OSP and ICEM heatmap features of the classifier, every endmember detected against all others:
+    osp/cem_absolute on the absorbance, osp/cem_rel_lit and osp/cem_rel_mc on the absorbance relative to a reference spectrum
+    of normal tissue, with the literature and Monte Carlo endmembers. The correlation matrices exclude the background (label 4).
+    input:
+        absorbance: absorbance image, shape (m,l,k)
+        reference_spectrum: absorbance of normal tissue, shape (k,)
+        M_lit: literature endmember spectra, shape (k, n)
+        M_mc: Monte Carlo endmember spectra, shape (k, n)
+        lmda: ICEM regularization parameter, float
+        labels: ground truth map, shape (m,l) (optional)
+        folder: if given, the heatmaps are saved as <name>.npy in this folder
+    output:
+        heatmaps, dict of np.arrays of shape (m,l,n) keyed by feature file name
+    '''
+    diff_absorbance = absorbance - reference_spectrum
+    mask = None if labels is None else np.asarray(labels).squeeze() != 4
+    proj_lit, targets_lit = leave_one_out(M_lit)
+    proj_mc, targets_mc = leave_one_out(M_mc)
+    R = CorrelationAccumulator.from_spectra(absorbance, mask).R
+    R_diff = CorrelationAccumulator.from_spectra(diff_absorbance, mask).R
+    # the filters of all features on the same input are applied in one pass
+    W = osp_filters(proj_lit, targets_lit), icem_filters(R, targets_lit, lmda)
+    W_diff = osp_filters(proj_lit, targets_lit), osp_filters(proj_mc, targets_mc), icem_filters(R_diff, targets_lit, lmda), icem_filters(R_diff, targets_mc, lmda)
+    names = ["osp_absolute", "cem_absolute"], ["osp_rel_lit", "osp_rel_mc", "cem_rel_lit", "cem_rel_mc"]
+    heatmaps = {}
+    for spectr, filters, feature_names in zip((absorbance, diff_absorbance), (W, W_diff), names):
+        stacked = apply_filters(spectr, np.concatenate(filters))
+        bounds = np.cumsum([0] + [f.shape[0] for f in filters])
+        for name, b0, b1 in zip(feature_names, bounds[:-1], bounds[1:]):
+            heatmaps[name] = stacked[..., b0:b1]
+    if folder is not None:
+        for name, heatmap in heatmaps.items():
+            np.save(f"{folder}/{name}.npy", heatmap)
+    return heatmaps
+
+class CorrelationAccumulator:
+    '''
+    Streaming accumulator of the autocorrelation matrix R = M^T M / N used by CEM/ICEM, and of the mean and covariance.
+    Spectra are added chunk by chunk (e.g. row tiles of a memory-mapped absorbance cube), partial results of
+    several images or workers can be merged, and the accumulated state can be saved and loaded.
+    Sums are kept in float64, so R matches M.T @ M / N computed at once.
+
+    usage:
+        acc = CorrelationAccumulator(k)
+        acc.update_cube(np.load(data_folder + "/preprocessed.npy", mmap_mode='r'), mask=labels != 4)
+        heatmap = icem(absorbance, t, lmda, R=acc.R)
+    '''
+    def __init__(self, n_bands):
+        self.n_bands = n_bands
+        self.count = 0
+        self.sum = np.zeros(n_bands, dtype=np.float64)
+        self.outer = np.zeros((n_bands, n_bands), dtype=np.float64)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_bands={self.n_bands}, count={self.count})"
+
+    @classmethod
+    def from_spectra(cls, spectr, mask=None, tile_rows=64):
+        '''
+        Accumulator of the spectra of shape (...,k) selected by mask, images of shape (m,l,k) are read in row tiles,
+        so only one tile at a time is converted to float64.
+        '''
+        acc = cls(spectr.shape[-1])
+        if len(spectr.shape) == 3:
+            return acc.update_cube(spectr, tile_rows, mask=None if mask is None else np.asarray(mask, dtype=bool).reshape(spectr.shape[:2]))
+        return acc.update(spectr, mask)
+
+    def update(self, spectr, mask=None):
+        '''
+        Add spectra to the accumulator.
+        input:
+            spectr: spectra, shape (...,k) where k is the number of bands
+            mask: boolean mask of the spectra to use, shape (...) (optional)
+        '''
+        spectr = np.asarray(spectr)
+        if mask is not None:
+            spectr = spectr[np.asarray(mask, dtype=bool)]
+        M = spectr.reshape(-1, self.n_bands).astype(np.float64)
+        self.count += M.shape[0]
+        self.sum += M.sum(axis=0)
+        self.outer += M.T @ M
+        return self
+
+    def update_cube(self, cube, tile_rows=64, mask=None):
+        '''
+        Add all spectra of a (memory-mapped) cube of shape (m,l,k), reading it in row tiles.
+        input:
+            cube: image, np.array or np.memmap of shape (m,l,k)
+            tile_rows: number of rows per tile, int
+            mask: boolean mask of the pixels to use, shape (m,l) (optional)
+        '''
+        for r0, r1 in _row_tiles(cube.shape[0], tile_rows):
+            self.update(cube[r0:r1], None if mask is None else mask[r0:r1])
+        return self
+
+    def merge(self, other):
+        '''
+        Merge the partial result of another accumulator (other image or worker) into this one.
+        '''
+        if other.n_bands != self.n_bands:
+            raise ValueError("Accumulators must have the same number of bands")
+        self.count += other.count
+        self.sum += other.sum
+        self.outer += other.outer
+        return self
+
+    @property
+    def R(self):
+        '''
+        Autocorrelation matrix M^T M / N, shape (k,k)
+        '''
+        return self.outer / self.count
+
+    @property
+    def mean(self):
+        '''
+        Mean spectrum, shape (k,)
+        '''
+        return self.sum / self.count
+
+    def covariance(self, ddof=0):
+        '''
+        Covariance matrix of the spectra, shape (k,k)
+        input:
+            ddof: delta degrees of freedom, the divisor is N - ddof
+        '''
+        mean = self.mean
+        return (self.outer - self.count * np.outer(mean, mean)) / (self.count - ddof)
+
+    def save(self, path):
+        '''
+        Save the accumulated state to a .npz file.
+        '''
+        np.savez(path, count=self.count, sum=self.sum, outer=self.outer)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load an accumulator saved with save.
+        '''
+        data = np.load(path)
+        acc = cls(data["sum"].shape[0])
+        acc.count = int(data["count"])
+        acc.sum = data["sum"]
+        acc.outer = data["outer"]
+        return acc
+
 def cosine_similarity(abs, spectr):
     '''
     Calculate the cosine similarity between the absorbance and the endmember spectra.
@@ -144,7 +759,7 @@ def cosine_similarity(abs, spectr):
     output:
         cosine similarity, np.array of shape (...)
     '''
-    return np.einsum("...k,k->...", abs, spectr) / (np.linalg.norm(abs, axis=2) * np.linalg.norm(spectr))
+    return np.einsum("...k,k->...", abs, spectr) / (np.linalg.norm(abs, axis=-1) * np.linalg.norm(spectr))
 
 def similarity(abs, spectr):
     '''
@@ -157,47 +772,158 @@ def similarity(abs, spectr):
     '''
     return np.einsum("...k,k->...", abs, spectr)
 
-def calibrate_img(img, white_ref, dark_ref):
+class SpectralLibrary:
+    '''
+    Library of reference spectra (extinctions, MC spectra, labeled class means) matched against every pixel of a cube.
+    Normalized library vectors are computed once, a tile of pixels is scored against the whole library with one matrix
+    product, and the top-k matches per pixel are kept.
+    Metrics: "cosine" (cosine similarity, higher is better), "sam" (spectral angle in radians, lower is better),
+    "euclidean" (distance, lower is better) and "correlation" (Pearson correlation over the bands, higher is better).
+
+    usage:
+        library = SpectralLibrary(M.T, names)      # or SpectralLibrary.from_class_means(stats, class_labels)
+        idx, scores = library.match(absorbance, top_k=3, metric="sam")
+    '''
+    metrics = ("cosine", "sam", "euclidean", "correlation")
+
+    def __init__(self, spectra, names=None):
+        self.spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+        self.names = list(names) if names is not None else [str(i) for i in range(self.spectra.shape[0])]
+        if len(self.names) != self.spectra.shape[0]:
+            raise ValueError("names must have one entry per library spectrum")
+        self.sq_norms = np.sum(np.square(self.spectra), axis=1)
+        self.unit = self.spectra / np.sqrt(self.sq_norms)[:, None]
+        centered = self.spectra - self.spectra.mean(axis=1, keepdims=True)
+        self.centered_unit = centered / np.linalg.norm(centered, axis=1, keepdims=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_spectra={self.spectra.shape[0]}, n_bands={self.spectra.shape[1]})"
+
+    @classmethod
+    def from_class_means(cls, stats, names=None):
+        '''
+        Library of the class mean spectra of a ClassStatistics object, named by class label if names is None.
+        '''
+        if names is None:
+            names = [str(c) for c in stats.classes]
+        return cls(stats.mean, names)
+
+    def scores(self, spectra, metric="cosine"):
+        '''
+        Scores of spectra against all library spectra.
+        input:
+            spectra: np.array of shape (N,k)
+            metric: one of SpectralLibrary.metrics
+        output:
+            scores, np.array of shape (N, n_spectra)
+        '''
+        X = np.asarray(spectra, dtype=np.float32)
+        if metric in ("cosine", "sam"):
+            norms = np.linalg.norm(X, axis=1, keepdims=True)
+            S = (X @ self.unit.T.astype(np.float32)) / np.maximum(norms, np.finfo(np.float32).tiny)
+            return np.arccos(np.clip(S, -1, 1)) if metric == "sam" else S
+        if metric == "euclidean":
+            # the expansion ||x||^2 - 2 x.s + ||s||^2 cancels for close matches, so it is done in float64
+            X = X.astype(np.float64)
+            sq = np.sum(np.square(X), axis=1, keepdims=True)
+            return np.sqrt(np.maximum(sq - 2 * (X @ self.spectra.T) + self.sq_norms, 0))
+        if metric == "correlation":
+            # the centered library vectors sum to zero, so the pixel mean drops out of the product
+            centered_norms = np.linalg.norm(X - X.mean(axis=1, keepdims=True), axis=1, keepdims=True)
+            return (X @ self.centered_unit.T.astype(np.float32)) / np.maximum(centered_norms, np.finfo(np.float32).tiny)
+        raise ValueError(f"Unknown metric {metric}, use one of {self.metrics}")
+
+    def _top_k(self, S, top_k, metric):
+        '''
+        Indices and scores of the best top_k matches per row of S, best first.
+        '''
+        order_scores = -S if metric in ("cosine", "correlation") else S
+        top_k = min(top_k, S.shape[1])
+        idx = np.argpartition(order_scores, top_k - 1, axis=1)[:, :top_k]
+        idx = np.take_along_axis(idx, np.argsort(np.take_along_axis(order_scores, idx, axis=1), axis=1), axis=1)
+        return idx, np.take_along_axis(S, idx, axis=1)
+
+    def match(self, cube, top_k=1, metric="cosine", tile_rows=64, chunk_size=1 << 16):
+        '''
+        Top-k library matches for every pixel, streaming the cube in row tiles.
+        input:
+            cube: spectra of shape (...,k), or an image of shape (m,l,k) as np.array, np.memmap or SpyFile
+            top_k: number of matches per pixel, int
+            metric: one of SpectralLibrary.metrics
+            tile_rows: number of rows per tile for images, int
+            chunk_size: number of pixels per chunk for other shapes, int
+        output:
+            idx: indices of the matching library spectra, best first, np.array of shape (..., top_k)
+            scores: scores of the matches, np.array of shape (..., top_k)
+        '''
+        top_k = min(top_k, self.spectra.shape[0])
+        shape = tuple(cube.shape[:-1])
+        idx = np.zeros(shape + (top_k,), dtype=np.int64)
+        scores = np.zeros(shape + (top_k,), dtype=np.float32)
+        if len(shape) == 2:
+            for r0, r1 in _row_tiles(shape[0], tile_rows):
+                tile = get_array(cube, rows=(r0, r1))
+                tile_idx, tile_scores = self._top_k(self.scores(tile.reshape(-1, tile.shape[-1]), metric), top_k, metric)
+                idx[r0:r1] = tile_idx.reshape(tile.shape[:-1] + (top_k,))
+                scores[r0:r1] = tile_scores.reshape(tile.shape[:-1] + (top_k,))
+        else:
+            X = np.asarray(cube).reshape(-1, cube.shape[-1])
+            flat_idx, flat_scores = idx.reshape(-1, top_k), scores.reshape(-1, top_k)
+            for p0, p1 in _row_tiles(X.shape[0], chunk_size):
+                flat_idx[p0:p1], flat_scores[p0:p1] = self._top_k(self.scores(X[p0:p1], metric), top_k, metric)
+        return idx, scores
+
+def calibrate_img(img, white_ref, dark_ref, out=None, inplace=False):
     '''
     Calibrate the image using the white and dark references.
     input:
         img: image to calibrate, shape (...,k) where k is the number of bands and ... are the spatial or time dimensions
         white_ref: white reference, shape (...,k) where m is the number of white reference pixels
         dark_ref: white reference, shape (...,k) where n is the number of dark reference pixels
+        out: C-contiguous float32 array of the shape of img the result is written to (optional)
+        inplace: if True and img is a float32 array, img is calibrated in place
     output:
         calibrated image as np.array
     '''
-    img, white_ref, dark_ref = get_array(img), get_array(white_ref), get_array(dark_ref)
+    # calculate illumination spectrum E, see ReferenceModel
+    reference = ReferenceModel.from_references(white_ref, dark_ref)
     # calculate reflectance
-    R = np.subtract(img, dark_ref, dtype=np.float32)
-    # calculate illumination spectrum E
-    # first subract dark reference from white reference pixel-wise to get rid of pixel differences, then average over pixels to minimize noise
-    E = np.mean(np.subtract(white_ref, dark_ref, dtype=np.float32), axis=-2, keepdims=True)
-    img_calibrated = np.divide(R,E)
-    return img_calibrated
+    img_calibrated = get_array(img, out=out, inplace=inplace)
+    return reference.calibrate_tile(img_calibrated)
 
-def band_removal(img, new_range, orig_bands=None):
+def _bands_to_slice(idx):
+    '''
+    Converts a boolean band mask to a slice if the selected bands are contiguous, so they can be read as one block.
+    '''
+    idx = np.flatnonzero(idx)
+    if len(idx) == 0 or np.any(np.diff(idx) != 1):
+        return idx
+    return slice(idx[0], idx[-1] + 1)
+
+def band_removal(img, new_range, orig_bands=None, rows=None, cols=None):
     '''
     Remove bands from the image that are not in the specified range.
+    For SpyFiles only the kept bands (and the optional ROI) are read from disk.
     input:
         img: image to convert, shape (...,k) where k is the number of bands and ... are the spatial or time dimensions
         new_range: range of bands to keep, list containing min and max band
         orig_bands: original band centers, list
+        rows: row bounds (start, stop) of the ROI to keep (optional)
+        cols: column bounds (start, stop) of the ROI to keep (optional)
     output:
         image as numpy array
     '''
-    if isinstance(img, sp.io.bilfile.BilFile):
+    if isinstance(img, sp.io.spyfile.SpyFile):
         orig_bands = img.bands.centers
     if orig_bands is None:
         raise ValueError("orig_bands must be provided when img is not a SpyFile")
-    img = get_array(img)
     orig_bands = np.array(orig_bands).squeeze()
     idx = (orig_bands >= new_range[0]) & (orig_bands <= new_range[1])
-    img_cropped = img[...,idx]
+    img_cropped = get_array(img, bands=_bands_to_slice(idx), rows=rows, cols=cols)
     new_bands = orig_bands[idx]
     return img_cropped, new_bands
 
-def calibrate_img_advanced(img, white_ref, dark_ref, average_ref_pixels=False):
+def calibrate_img_advanced(img, white_ref, dark_ref, average_ref_pixels=False, out=None, inplace=False):
     '''
     Calibrate the image using the white and dark references using normalization from https://link.springer.com/chapter/10.1007/978-3-031-18256-3_43.
     input:
@@ -205,68 +931,280 @@ def calibrate_img_advanced(img, white_ref, dark_ref, average_ref_pixels=False):
         white_ref: white reference, np.array or SpyFile
         dark_ref: white reference, np.array or SpyFile
         average_ref_pixels: if True, average the white and dark references over the input image before calibration
+        out: C-contiguous float32 array of the shape of img the result is written to (optional)
+        inplace: if True and img is a float32 array, img is calibrated in place
     output:
         calibrated image as np.array
     '''
-    img, white_ref, dark_ref = get_array(img), get_array(white_ref), get_array(dark_ref)
+    white_ref, dark_ref = get_array(white_ref), get_array(dark_ref)
+    img_calibrated = get_array(img, out=out, inplace=inplace)
     if average_ref_pixels:
         white_ref = np.mean(white_ref, axis=(0,1))
         dark_ref = np.mean(dark_ref, axis=(0,1))
-        white_ref = np.tile(white_ref, (img.shape[1], 1))
-        dark_ref = np.tile(dark_ref, (img.shape[1], 1))
-    alpha = np.subtract(img, dark_ref, dtype=np.float32)
-    beta = np.subtract(white_ref, dark_ref, dtype=np.float32) - np.min(alpha)
+        white_ref = np.tile(white_ref, (img_calibrated.shape[1], 1))
+        dark_ref = np.tile(dark_ref, (img_calibrated.shape[1], 1))
+    # alpha = img - dark_ref
+    img_calibrated -= dark_ref
+    alpha_min = np.min(img_calibrated)
+    beta = np.subtract(white_ref, dark_ref, dtype=np.float32) - alpha_min
     beta_hat = np.divide(beta, np.max(beta, axis=(0,1)))
-    alpha_hat = np.divide(alpha - np.min(alpha), beta_hat)
-    img_calibrated = np.divide(alpha_hat, np.max(alpha_hat, axis=(0,1))) * 100
+    # alpha_hat = (alpha - min(alpha)) / beta_hat
+    img_calibrated -= alpha_min
+    img_calibrated /= beta_hat
+    img_calibrated /= np.max(img_calibrated, axis=(0,1))
+    img_calibrated *= 100
     return img_calibrated
 
-def l1_normalize(img):
+def l1_normalize(img, out=None, inplace=False):
     '''
     Normalize the image spectral signatures pixel-wise to unit L1 norm.
     Spectral dimension must be the last dimension.
     input:
         img: image to normalize, np.array or SpyFile
+        out: C-contiguous float32 array of the shape of img the result is written to (optional)
+        inplace: if True and img is a float32 array, img is normalized in place
     output:
         image as np.array
     '''
-    img = get_array(img)
-    img_norm = np.divide(img, np.linalg.norm(img, ord=1, axis=-1, keepdims=True))
+    img_norm = get_array(img, out=out, inplace=inplace)
+    for x in _pixel_chunks(img_norm):
+        x /= np.add.reduce(np.abs(x), axis=-1, keepdims=True)
     return img_norm
 
-def normalize_bands_std(img, class_wise=False, gt_map=None):
+def _labels_like(gt_map, img):
+    '''
+    Returns the ground truth map as flat integer labels matching the pixels of img, gt_map of shape (m,l) or (m,l,1).
+    '''
+    if isinstance(gt_map, sp.io.spyfile.SpyFile):
+        gt_map = gt_map.asarray()
+    return np.asarray(gt_map).reshape(-1).astype(np.int64)
+
+
+class ClassStatistics:
+    '''
+    Per-class band-wise statistics (count, mean, std, min, max) computed in a single pass over the image.
+    The pixels of each chunk are grouped by label with one sort and gather, so every class is reduced on a
+    contiguous block instead of scanning the whole image once per class with a mask.
+    Means and variances are merged across chunks with the pairwise update of Chan et al., so they stay accurate in float64.
+    Statistics of several images can be pooled by calling update for each image (or by merging),
+    e.g. for dataset-level class-wise normalization.
+    '''
+    def __init__(self, n_bands):
+        self.n_bands = n_bands
+        self.classes = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, n_bands), dtype=np.float64)
+        self.m2 = np.zeros((0, n_bands), dtype=np.float64)
+        self.min = np.zeros((0, n_bands), dtype=np.float64)
+        self.max = np.zeros((0, n_bands), dtype=np.float64)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_bands={self.n_bands}, classes={self.classes.tolist()})"
+
+    def _add_classes(self, classes):
+        '''
+        Extend the statistics arrays with not yet seen classes, keeping the classes sorted.
+        '''
+        new = np.setdiff1d(classes, self.classes)
+        if len(new) == 0:
+            return
+        classes = np.concatenate((self.classes, new))
+        order = np.argsort(classes)
+        n_new = len(new)
+        pad = lambda arr, value: np.concatenate((arr, np.full((n_new,) + arr.shape[1:], value, dtype=arr.dtype)))[order]
+        self.count = pad(self.count, 0)
+        self.mean = pad(self.mean, 0)
+        self.m2 = pad(self.m2, 0)
+        self.min = pad(self.min, np.inf)
+        self.max = pad(self.max, -np.inf)
+        self.classes = classes[order]
+
+    def class_index(self, labels):
+        '''
+        Returns the row of the statistics arrays for every label.
+        '''
+        idx = np.searchsorted(self.classes, labels)
+        if np.any(idx >= len(self.classes)) or np.any(self.classes[np.minimum(idx, len(self.classes) - 1)] != labels):
+            raise ValueError("gt_map contains classes without statistics")
+        return idx
+
+    def _merge_rows(self, rows, count, mean, m2, min, max):
+        '''
+        Merge partial statistics into the given class rows.
+        '''
+        n_a = self.count[rows][:, None]
+        n_b = np.asarray(count)[:, None]
+        n = n_a + n_b
+        delta = mean - self.mean[rows]
+        self.mean[rows] += delta * (n_b / n)
+        self.m2[rows] += m2 + np.square(delta) * (n_a * n_b / n)
+        self.count[rows] = n[:, 0]
+        self.min[rows] = np.minimum(self.min[rows], min)
+        self.max[rows] = np.maximum(self.max[rows], max)
+
+    def update(self, img, gt_map, chunk_size=8192):
+        '''
+        Add the pixels of an image to the statistics.
+        input:
+            img: image, shape (...,k) where k is the number of bands
+            gt_map: ground truth map with the class of every pixel, shape (...) or (...,1)
+            chunk_size: number of pixels processed at once, int
+        '''
+        img = np.asarray(img)
+        X = img.reshape(-1, self.n_bands)
+        labels = _labels_like(gt_map, img)
+        self._add_classes(np.unique(labels))
+        idx = self.class_index(labels)
+        for p0, p1 in _row_tiles(X.shape[0], chunk_size):
+            order = np.argsort(idx[p0:p1], kind='stable')
+            chunk = X[p0:p1][order]
+            chunk_idx = idx[p0:p1][order]
+            bounds = np.flatnonzero(np.diff(chunk_idx)) + 1
+            starts, stops = np.r_[0, bounds], np.r_[bounds, len(chunk_idx)]
+            rows = chunk_idx[starts]
+            block_mean = np.zeros((len(rows), self.n_bands))
+            block_m2 = np.zeros((len(rows), self.n_bands))
+            block_min = np.zeros((len(rows), self.n_bands))
+            block_max = np.zeros((len(rows), self.n_bands))
+            for i, (b0, b1) in enumerate(zip(starts, stops)):
+                block = chunk[b0:b1]
+                block_mean[i] = np.mean(block, axis=0, dtype=np.float64)
+                block_m2[i] = np.sum(np.square(block - block_mean[i].astype(block.dtype)), axis=0, dtype=np.float64)
+                block_min[i] = np.min(block, axis=0)
+                block_max[i] = np.max(block, axis=0)
+            self._merge_rows(rows, stops - starts, block_mean, block_m2, block_min, block_max)
+        return self
+
+    def merge(self, other):
+        '''
+        Pool the statistics of another ClassStatistics object into this one.
+        '''
+        self._add_classes(other.classes)
+        self._merge_rows(self.class_index(other.classes), other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    @property
+    def std(self):
+        '''
+        Class standard deviations per band (ddof=0 like np.std), shape (n_classes, k)
+        '''
+        return np.sqrt(self.m2 / self.count[:, None])
+
+def _apply_class_wise(img, labels, stats, func, chunk_size=1 << 16):
+    '''
+    Apply func(pixels, class_rows) in place to the pixels of img chunk by chunk, where class_rows indexes the statistics arrays.
+    '''
+    X = img.reshape(-1, img.shape[-1])
+    idx = stats.class_index(labels)
+    for p0, p1 in _row_tiles(X.shape[0], chunk_size):
+        func(X[p0:p1], idx[p0:p1])
+
+def normalize_bands_std(img, class_wise=False, gt_map=None, stats=None, inplace=False):
     '''
     Normalize the image spectral signatures band-wise to unit variance.
+    input:
+        img: image to normalize, np.array or SpyFile
+        class_wise: if True, normalize each class separately, bool
+        gt_map: ground truth map, np.array or SpyFile
+        stats: precomputed ClassStatistics (e.g. pooled over several images), computed from img if None
+        inplace: if True and img is a float32 array, img is normalized in place
+    output:
+        image as np.array
     '''
-    img, gt_map = get_array(img), get_array(gt_map)
-    img_norm = np.zeros_like(img)
+    img = get_array(img, inplace=inplace)
     if class_wise:
         if gt_map is None:
             raise ValueError("gt_map must be provided when class_wise is True")
-        classes = np.unique(gt_map)
-        for class_id in classes:
-            mask = np.where(gt_map[:,:,0] == class_id)
-            class_std = np.std(img[mask], axis=0)
-            class_mean = np.mean(img[mask], axis=0)
-            img_norm[mask] = (img[mask] - class_mean) / class_std + class_mean
+        labels = _labels_like(gt_map, img)
+        if stats is None:
+            stats = ClassStatistics(img.shape[-1]).update(img, labels)
+        class_mean = stats.mean.astype(np.float32)
+        class_std = stats.std.astype(np.float32)
+        def normalize(x, rows):
+            x -= class_mean[rows]
+            x /= class_std[rows]
+            x += class_mean[rows]
+        _apply_class_wise(img, labels, stats, normalize)
     else:
-        img_norm = (img - np.mean(img, axis=(0,1))) / np.std(img, axis=(0,1)) + np.mean(img, axis=(0,1))
-    return img_norm
+        mean, std = np.mean(img, axis=(0,1)), np.std(img, axis=(0,1))
+        img -= mean
+        img /= std
+        img += mean
+    return img
 
-def smooth_spectral(img, window_size=5):
+def smooth_spectral(img, window_size=5, out=None):
     '''
     Smooth the image using a mean filter.
     input:
         img: image to smooth, np.array or SpyFile
         window_size: size of the smoothing window, int
+        out: C-contiguous float32 array of the shape of img the result is written to, must not be img (optional)
     output:
         smoothed image as np.array
     '''
-    img = get_array(img)
+    img = get_array(img, inplace=True)
     kernel = np.ones(window_size)/window_size
-    img_smooth = convolve1d(img, kernel, mode='nearest', axis=-1)
+    if out is not None:
+        if out is img:
+            raise ValueError("smooth_spectral can not be computed in place, out must be a separate buffer")
+        _check_out(out, img.shape)
+    img_smooth = convolve1d(img, kernel, mode='nearest', axis=-1, output=out)
     return img_smooth
 
+@lru_cache(maxsize=16)
+def _interpolation_plan(bands_old, range_new):
+    '''
+    Precompute the 2-tap linear interpolation weights from bands_old to 1nm steps in range_new.
+    Cached, so the same band grid is only processed once across patients.
+    input:
+        bands_old: original band centers, tuple of floats (ascending)
+        range_new: new bands range, tuple containing min and max band
+    output:
+        idx: index of the lower neighbouring old band for every new band, shape (k_new,)
+        weights: weights of the lower and upper neighbour, shape (2, k_new), float32
+        bands_new: new bands with stepsize 1nm
+    '''
+    bands_old = np.asarray(bands_old, dtype=np.float64)
+    bands_new = np.arange(range_new[0], range_new[1] + 1)
+    if bands_old[0] > bands_new[0] or bands_old[-1] < bands_new[-1]:
+        raise ValueError("Interpolation range is out of bounds")
+    # same neighbour selection as np.interp, the last new band may coincide with the last old band
+    idx = np.clip(np.searchsorted(bands_old, bands_new, side='right') - 1, 0, len(bands_old) - 2)
+    w_upper = (bands_new - bands_old[idx]) / (bands_old[idx + 1] - bands_old[idx])
+    weights = np.stack((1 - w_upper, w_upper)).astype(np.float32)
+    for arr in (idx, weights, bands_new):
+        arr.flags.writeable = False
+    return idx, weights, bands_new
+
+def get_interpolation_plan(bands_old, range_new):
+    '''
+    Returns the (cached) interpolation plan for resampling bands_old to 1nm steps in range_new.
+    input:
+        bands_old: bands of the original spectrogram
+        range_new: new bands range, list containing min and max band
+    output:
+        plan: tuple (idx, weights, bands_new), see _interpolation_plan
+    '''
+    bands_old = tuple(np.asarray(bands_old, dtype=np.float64).squeeze().tolist())
+    return _interpolation_plan(bands_old, (range_new[0], range_new[1]))
+
+def apply_interpolation_plan(spectr, plan):
+    '''
+    Apply a precomputed interpolation plan to all spectra at once.
+    input:
+        spectr: spectra to interpolate, np.array of shape (...,k) where k is the number of original bands
+        plan: interpolation plan from get_interpolation_plan
+    output:
+        interpolated spectra, np.array of shape (...,k_new) as float32
+    '''
+    idx, weights, _ = plan
+    spectr_new = np.take(spectr, idx, axis=-1)
+    spectr_new *= weights[0]
+    upper = np.take(spectr, idx + 1, axis=-1)
+    upper *= weights[1]
+    spectr_new += upper
+    return spectr_new
+
 def bands_lin_interpolation(spectr, bands_old, range_new):
     """
     interpolate spectrogram values to new bands
@@ -277,52 +1215,45 @@ def bands_lin_interpolation(spectr, bands_old, range_new):
             bands_new, new bands with stepsize 1nm
     """
     spectr = get_array(spectr)
-    bands_new = np.arange(range_new[0], range_new[1] + 1)
-    if bands_old[0] > bands_new[0] or bands_old[-1] < bands_new[-1]:
-        raise ValueError("Interpolation range is out of bounds")
-    if spectr.ndim == 1:
-        spectr_new = np.interp(bands_new, bands_old, spectr)
-    if spectr.ndim == 2:
-        spectr_new = np.zeros((spectr.shape[0], bands_new.shape[0]))
-        for i in range(spectr.shape[0]):
-            spectr_new[i,:] = np.interp(bands_new, bands_old, spectr[i,:])
-    if spectr.ndim == 3:
-        spectr_new = np.zeros((spectr.shape[0], spectr.shape[1], bands_new.shape[0]))
-        for i in range(spectr.shape[0]):
-            for j in range(spectr.shape[1]):
-                spectr_new[i,j,:] = np.interp(bands_new, bands_old, spectr[i,j,:])
-    return spectr_new, bands_new
-
-def to_absorbance(img):
+    plan = get_interpolation_plan(bands_old, range_new)
+    spectr_new = apply_interpolation_plan(spectr, plan)
+    return spectr_new, plan[2].copy()
+
+def to_absorbance(img, out=None, inplace=False):
     '''
     Convert image spectral signatures to absorbance.
     A(lambda) = -log(img(lambda)).
     input:
         img: image to convert, np.array or SpyFile
+        out: C-contiguous float32 array of the shape of img the result is written to (optional)
+        inplace: if True and img is a float32 array, img is converted in place
     output:
         image as np.array
     '''
-    img = get_array(img)
-    img_absorbance = -np.log(img)
+    img_absorbance = get_array(img, out=out, inplace=inplace)
+    np.log(img_absorbance, out=img_absorbance)
+    np.negative(img_absorbance, out=img_absorbance)
     return img_absorbance
 
-def normalize_spectral_interval(img):
+def normalize_spectral_interval(img, out=None, inplace=False):
     '''
     Normalize the image spectral signatures pixel-wise to the interval [0,1].
     input:
         img: image to normalize, np.array or SpyFile
+        out: C-contiguous float32 array of the shape of img the result is written to (optional)
+        inplace: if True and img is a float32 array, img is normalized in place
     output:
         image as np.array
     '''
-    img = get_array(img)
-    img_min = np.min(img, axis=-1)[..., np.newaxis]
-    img_max = np.max(img, axis=-1)[..., np.newaxis]
-    img_spectral_norm = np.divide(
-        np.subtract(img, img_min),
-        np.subtract(img_max, img_min))
+    img_spectral_norm = get_array(img, out=out, inplace=inplace)
+    for x in _pixel_chunks(img_spectral_norm):
+        x_min = np.min(x, axis=-1, keepdims=True)
+        x_max = np.max(x, axis=-1, keepdims=True)
+        x -= x_min
+        x /= x_max - x_min
     return img_spectral_norm
 
-def normalize_spectral_interval_mean(img, class_wise=False, gt_map=None):
+def normalize_spectral_interval_mean(img, class_wise=False, gt_map=None, stats=None, inplace=False):
     '''
     Normalize the image spectral signatures mean to [0,1].
     If class_wise is True, normalize each class separately.
@@ -330,29 +1261,166 @@ def normalize_spectral_interval_mean(img, class_wise=False, gt_map=None):
         img: image to normalize, np.array or SpyFile
         class_wise: if True, normalize each class separately, bool
         gt_map: ground truth map, np.array or SpyFile
+        stats: precomputed ClassStatistics (e.g. pooled over several images), computed from img if None
+        inplace: if True and img is a float32 array, img is normalized in place
     output:
         image as np.array
     '''
-    img = get_array(img)
+    img = get_array(img, inplace=inplace)
     if class_wise:
-        img_spectral_norm = np.zeros_like(img)
         if gt_map is None:
             raise ValueError("gt_map must be provided when class_wise is True")
-        gt_map = get_array(gt_map)
-        classes = np.unique(gt_map)
-        for class_id in classes:
-            mask = np.where(gt_map[:,:,0] == class_id)
-            class_mean = np.mean(img[mask], axis=0)
-            class_mean_min = np.min(class_mean, axis=0)
-            class_mean_max = np.max(class_mean, axis=0)
-            img_spectral_norm[mask] = np.divide(
-                np.subtract(img[mask], class_mean_min),
-                np.subtract(class_mean_max, class_mean_min))
+        labels = _labels_like(gt_map, img)
+        if stats is None:
+            stats = ClassStatistics(img.shape[-1]).update(img, labels)
+        class_mean = stats.mean
+        class_mean_min = np.min(class_mean, axis=1, keepdims=True).astype(np.float32)
+        class_mean_range = (np.max(class_mean, axis=1, keepdims=True) - class_mean_min).astype(np.float32)
+        def normalize(x, rows):
+            x -= class_mean_min[rows]
+            x /= class_mean_range[rows]
+        _apply_class_wise(img, labels, stats, normalize)
     else:
         spectral_mean = np.mean(img, axis=(0,1))
         mean_min = np.min(spectral_mean)
         mean_max = np.max(spectral_mean)
-        img_spectral_norm = np.divide(
-            np.subtract(img, mean_min),
-            np.subtract(mean_max, mean_min))
-    return img_spectral_norm
\ No newline at end of file
+        img -= mean_min
+        img /= mean_max - mean_min
+    return img
+
+
+def _row_tiles(n_rows, tile_rows):
+    '''
+    Yields (start, stop) row bounds of consecutive tiles covering n_rows rows.
+    '''
+    for r0 in range(0, n_rows, tile_rows):
+        yield r0, min(r0 + tile_rows, n_rows)
+
+def _plan_band_subset(plan):
+    '''
+    Returns the contiguous slice of old bands an interpolation plan reads from, and the plan relative to that slice.
+    '''
+    idx, weights, bands_new = plan
+    b0, b1 = idx.min(), idx.max() + 2
+    return slice(b0, b1), (idx - b0, weights, bands_new)
+
+def _ref_rows(ref, r0, r1):
+    '''
+    Selects the rows of a reference matching an image tile, references with a single row are broadcast.
+    '''
+    if ref.ndim < 3 or ref.shape[0] == 1:
+        return ref
+    return ref[r0:r1]
+
+def _open_output(out, shape):
+    '''
+    Returns a float32 output array: newly allocated if out is None, a memory-mapped .npy file if out is a path, or out itself.
+    '''
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+    if out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+    return out
+
+
+class PreprocessingPipeline:
+    '''
+    Fused preprocessing from a raw cube to absorbance, processed in row tiles:
+    band interpolation -> calibration -> pixel-wise L1 normalization -> spectral smoothing -> -log.
+    Gives the same result as the chain in helicoid/preprocessing.ipynb, i.e.
+        img_calib = calibrate_img(bands_lin_interpolation(img), ...)
+        img_smooth = smooth_spectral(img_calib / np.linalg.norm(img_calib, axis=2, ord=1, keepdims=True), window_size)
+        absorbance = -np.log(img_smooth - np.min(img_smooth) + eps)
+    but only ever holds one tile of intermediate results next to the output.
+    The accumulated time per stage of the last run is stored in self.timings (seconds).
+    '''
+    stages = ["read", "interpolation", "calibration", "normalization", "smoothing", "absorbance"]
+
+    def __init__(self, bands_range=(520, 900), window_size=5, tile_rows=32, eps=1e-8):
+        self.bands_range = bands_range
+        self.window_size = window_size
+        self.tile_rows = tile_rows
+        self.eps = eps
+        self.timings = {stage: 0.0 for stage in self.stages}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(bands_range={self.bands_range}, window_size={self.window_size}, tile_rows={self.tile_rows})"
+
+    def _tic(self, stage, t0):
+        t1 = time.perf_counter()
+        self.timings[stage] += t1 - t0
+        return t1
+
+    def run(self, img, white_ref=None, dark_ref=None, bands_old=None, out=None, reference=None):
+        '''
+        Run the pipeline on one image.
+        input:
+            img: raw image, SpyFile or array of shape (m,l,k)
+            white_ref: white reference, SpyFile or array of shape (...,l,k), not needed if reference is given
+            dark_ref: dark reference, SpyFile or array of shape (...,l,k), not needed if reference is given
+            bands_old: band centers of the raw image, only needed if img is not a SpyFile
+            out: None, path of a .npy file to memory-map, or preallocated float32 array of shape (m,l,k_new)
+            reference: ReferenceModel of the acquisition session built with the same bands_range (optional)
+        output:
+            absorbance, np.array (or np.memmap) of shape (m,l,k_new)
+            bands_new, new bands with stepsize 1nm
+        '''
+        self.timings = {stage: 0.0 for stage in self.stages}
+        if isinstance(img, sp.io.spyfile.SpyFile):
+            bands_old = img.bands.centers
+        if bands_old is None:
+            raise ValueError("bands_old must be provided when img is not a SpyFile")
+        # only the bands between the first and last interpolation neighbour are read
+        band_slice, plan = _plan_band_subset(get_interpolation_plan(bands_old, self.bands_range))
+        bands_new = plan[2].copy()
+
+        # references are small, interpolate them once
+        t = time.perf_counter()
+        if reference is None:
+            reference = ReferenceModel.from_references(white_ref, dark_ref, self.window_size, bands_old, self.bands_range)
+        elif reference.plan is None or not np.array_equal(reference.bands, bands_new):
+            raise ValueError("reference must be built with the bands_range of the pipeline")
+        self._tic("calibration", t)
+
+        m, l = img.shape[:2]
+        out = _open_output(out, (m, l, len(bands_new)))
+        kernel = np.ones(self.window_size)/self.window_size
+        img_min = np.inf
+        for r0, r1 in _row_tiles(m, self.tile_rows):
+            t = time.perf_counter()
+            tile = get_array(img, bands=band_slice, rows=(r0, r1))
+            t = self._tic("read", t)
+            tile = apply_interpolation_plan(tile, plan)
+            t = self._tic("interpolation", t)
+            reference.calibrate_tile(tile, r0, r1)
+            t = self._tic("calibration", t)
+            tile /= np.linalg.norm(tile, ord=1, axis=-1, keepdims=True)
+            t = self._tic("normalization", t)
+            convolve1d(tile, kernel, mode='nearest', axis=-1, output=out[r0:r1])
+            img_min = min(img_min, np.min(out[r0:r1]))
+            t = self._tic("smoothing", t)
+
+        # the offset depends on the global minimum, so -log needs a second pass
+        t = time.perf_counter()
+        for r0, r1 in _row_tiles(m, self.tile_rows):
+            tile = out[r0:r1]
+            tile -= img_min
+            tile += self.eps
+            np.log(tile, out=tile)
+            np.negative(tile, out=tile)
+        self._tic("absorbance", t)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out, bands_new
+
+    def report(self):
+        '''
+        Returns the per-stage timings of the last run as a printable string.
+        '''
+        total = sum(self.timings.values())
+        lines = [f"{stage:<15}{seconds:8.2f} s" for stage, seconds in self.timings.items()]
+        lines.append(f"{'total':<15}{total:8.2f} s")
+        return "\n".join(lines)
+
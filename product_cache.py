@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+def envi_files(path):
+    '''
+    Returns the files belonging to an input path. For ENVI headers (.hdr) the data file next to it is included.
+    '''
+    files = [path]
+    if path.endswith(".hdr"):
+        for ext in ["", ".raw", ".img", ".dat", ".bil", ".bsq", ".bip"]:
+            data_file = path[:-4] + ext
+            if os.path.isfile(data_file):
+                files.append(data_file)
+                break
+    return files
+
+def _jsonable(obj):
+    '''
+    Converts parameters to a json serializable form, arrays are replaced by a hash of their content.
+    '''
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        digest = hashlib.sha256(obj.tobytes())
+        digest.update(f"{obj.dtype.str}{obj.shape}".encode())
+        return {"__ndarray__": digest.hexdigest()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {str(k): _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    raise TypeError(f"Unsupported parameter type {type(obj)}")
+
+
+class ProductCache:
+    '''
+    Content-addressed on-disk cache for derived per-patient arrays (preprocessed.npy, corr_matrix.npy, heatmaps, ...).
+    Every product is keyed on a hash of its input files, the name of the producing function and its parameters,
+    and stored as <key>.npy together with a <key>.json record of what produced it.
+    File hashes are memoized on (path, size, mtime), so unchanged raw cubes are only read once.
+
+    usage:
+        cache = ProductCache("../../datasets/cache")
+        absorbance = cache.get_or_compute("preprocessed", lambda: pipeline.run(img, white_ref, dark_ref)[0],
+                                          input_files=[data_folder + "/raw.hdr", ...],
+                                          params={"bands_range": [520,900], "window_size": 5})
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hash_index_file = os.path.join(cache_dir, "file_hashes.json")
+        self._hash_index = {}
+        if os.path.exists(self._hash_index_file):
+            with open(self._hash_index_file) as f:
+                self._hash_index = json.load(f)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(cache_dir={self.cache_dir!r}, entries={len(self.list_entries())})"
+
+    def file_hash(self, path, chunk_size=1 << 23):
+        '''
+        Returns the sha256 of a file's content, memoized on (path, size, mtime).
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = self._hash_index.get(path)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["sha256"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        self._hash_index[path] = {"stamp": stamp, "sha256": digest.hexdigest()}
+        tmp_file = self._hash_index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._hash_index, f)
+        os.replace(tmp_file, self._hash_index_file)
+        return self._hash_index[path]["sha256"]
+
+    def key(self, func_name, input_files=(), params=None):
+        '''
+        Returns the cache key of a product.
+        input:
+            func_name: name of the function producing the product, str
+            input_files: paths of the files the product is derived from, ENVI headers include their data file
+            params: parameters of the function (band range, smoothing window, endmember set, ...), dict
+        output:
+            key, hex str
+        '''
+        files = [f for path in input_files for f in envi_files(path)]
+        record = {
+            "func": func_name,
+            "inputs": sorted(self.file_hash(f) for f in files),
+            "params": _jsonable(params or {}),
+        }
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key + ".npy"), os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key, mmap_mode=None):
+        '''
+        Returns the cached array for key or None on a miss. A hit refreshes the access time used for eviction.
+        '''
+        array_file, _ = self._paths(key)
+        if not os.path.exists(array_file):
+            return None
+        os.utime(array_file)
+        return np.load(array_file, mmap_mode=mmap_mode)
+
+    def put(self, key, arr, func_name=None, input_files=(), params=None):
+        '''
+        Stores an array under key together with a json record of its provenance.
+        '''
+        array_file, meta_file = self._paths(key)
+        tmp_file = array_file + ".tmp.npy"
+        np.save(tmp_file, arr)
+        os.replace(tmp_file, array_file)
+        meta = {
+            "func": func_name,
+            "inputs": [os.path.abspath(f) for f in input_files],
+            "params": _jsonable(params or {}),
+            "shape": list(np.shape(arr)),
+            "dtype": str(np.asarray(arr).dtype),
+            "created": time.time(),
+        }
+        with open(meta_file, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def get_or_compute(self, func_name, compute, input_files=(), params=None, mmap_mode=None):
+        '''
+        Returns the cached product on a hit, otherwise calls compute() and stores its result.
+        input:
+            func_name: name of the function producing the product, str
+            compute: callable without arguments returning the product as array
+            input_files: paths of the files the product is derived from
+            params: parameters the product depends on, dict
+            mmap_mode: mmap_mode passed to np.load on a hit
+        output:
+            product, np.array
+        '''
+        key = self.key(func_name, input_files, params)
+        arr = self.get(key, mmap_mode=mmap_mode)
+        if arr is None:
+            arr = compute()
+            self.put(key, arr, func_name, input_files, params)
+        return arr
+
+    def list_entries(self):
+        '''
+        Returns the cache entries as a list of dicts with key, func, params, size (bytes), created and last_access (timestamps),
+        sorted from least to most recently used.
+        '''
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".npy") or file_name.endswith(".tmp.npy"):
+                continue
+            key = file_name[:-4]
+            array_file, meta_file = self._paths(key)
+            meta = {}
+            if os.path.exists(meta_file):
+                with open(meta_file) as f:
+                    meta = json.load(f)
+            stat = os.stat(array_file)
+            entries.append({
+                "key": key,
+                "func": meta.get("func"),
+                "params": meta.get("params"),
+                "size": stat.st_size,
+                "created": meta.get("created", stat.st_mtime),
+                "last_access": stat.st_mtime,
+            })
+        return sorted(entries, key=lambda e: e["last_access"])
+
+    def evict(self, max_size=None, max_age=None):
+        '''
+        Evict stale entries.
+        input:
+            max_size: maximum total size of the cache in bytes, least recently used entries are removed first (optional)
+            max_age: maximum time in seconds since the last access of an entry (optional)
+        output:
+            keys of the evicted entries, list
+        '''
+        entries = self.list_entries()
+        evicted = []
+        now = time.time()
+        if max_age is not None:
+            evicted += [e for e in entries if now - e["last_access"] > max_age]
+            entries = [e for e in entries if now - e["last_access"] <= max_age]
+        if max_size is not None:
+            total = sum(e["size"] for e in entries)
+            while entries and total > max_size:
+                entry = entries.pop(0)
+                total -= entry["size"]
+                evicted.append(entry)
+        for entry in evicted:
+            for path in self._paths(entry["key"]):
+                if os.path.exists(path):
+                    os.remove(path)
+        return [e["key"] for e in evicted]
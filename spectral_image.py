@@ -1,42 +1,247 @@
 import spectral as sp
-from spectral import BandInfo
 import numpy as np
 
-class SpectralImage(np.ndarray):
-    def __new__(cls, img, params=None, metadata=None, bands=None):
-        # Check if img is of type spectral.io.bilfile.BilFile
-        if isinstance(img, sp.io.bilfile.BilFile):
-            img_data = img.asarray()
-            bands = img.bands
-            params = img.params()
+from preprocessing import (get_array, get_interpolation_plan, apply_interpolation_plan, l1_normalize,
+                           smooth_spectral, to_absorbance, ClassStatistics, _row_tiles)
+
+
+class SpectralImage:
+    '''
+    Lazy container for a hyperspectral cube of shape (rows, cols, bands) that keeps the band centers,
+    the metadata and the processing history.
+    The data source is either a SpyFile (read through its memory map) or an array. Operations are only
+    recorded and executed when the data is materialized with to_array() or tile by tile with iter_tiles().
+    Slicing rows, columns or bands returns a new SpectralImage on the same source, no data is copied.
+
+    Recorded operations must be pixel-wise: func(tile, window) -> tile, where tile has shape (r,c,k) and
+    window = (r0, r1, c0, c1) are the bounds of the tile in source coordinates.
+
+    usage:
+        img = SpectralImage.open_image(data_folder + "/raw.hdr")
+        white_ref = SpectralImage.open_image(data_folder + "/whiteReference.hdr")
+        dark_ref = SpectralImage.open_image(data_folder + "/darkReference.hdr")
+        img = img.interpolate([520, 900]).calibrate(white_ref, dark_ref).l1_normalize().smooth(5)
+        roi = img[100:200, 50:150].to_array()
+    '''
+    def __init__(self, img, bands=None, metadata=None):
+        if isinstance(img, SpectralImage):
+            self.__dict__.update(img.copy().__dict__)
+            return
+        if isinstance(img, sp.io.spyfile.SpyFile):
+            bands = img.bands.centers
             metadata = img.metadata
-        elif isinstance(img, np.ndarray):
-            img_data = img
-            bands = bands
-            metadata = metadata
-            params = params
-        elif isinstance(img, __main__.SpectralImage):
-            return img.copy()
-        else:
+        elif not isinstance(img, np.ndarray):
             raise ValueError("Unsupported input type")
-
-        obj = np.asarray(img_data).view(cls)
-        obj.metadata = metadata
-        obj.processing_steps = []
-        obj.bands = bands
-        obj.nbands = params.nbands
-        obj.nrows = params.nrows
-        obj.ncols = params.ncols
-        obj.dtype = params.dtype
-        return obj
+        if len(img.shape) != 3:
+            raise ValueError("SpectralImage requires a cube of shape (rows, cols, bands)")
+        nrows, ncols, nbands = img.shape
+        self._source = img
+        self._rows = (0, nrows)
+        self._cols = (0, ncols)
+        # band selection on the source, applied while reading
+        self._band_sel = slice(0, nbands)
+        self._ops = []
+        self.bands = None if bands is None else np.asarray(bands, dtype=np.float64)
+        self.metadata = {} if metadata is None else metadata
+        self.processing_steps = []
 
     @staticmethod
     def open_image(filename):
-        img = sp.open_image(filename)
-        return SpectralImage(img)
+        return SpectralImage(sp.open_image(filename))
+
+    def copy(self):
+        '''
+        Returns a new SpectralImage on the same source with its own history, no data is copied.
+        '''
+        new = SpectralImage.__new__(SpectralImage)
+        new.__dict__.update(self.__dict__)
+        new._ops = list(self._ops)
+        new.processing_steps = list(self.processing_steps)
+        new.metadata = dict(self.metadata)
+        return new
+
+    @property
+    def shape(self):
+        nbands = len(self.bands) if self.bands is not None else len(np.arange(self._source.shape[-1])[self._band_sel])
+        return (self._rows[1] - self._rows[0], self._cols[1] - self._cols[0], nbands)
+
+    @property
+    def nrows(self):
+        return self.shape[0]
+
+    @property
+    def ncols(self):
+        return self.shape[1]
+
+    @property
+    def nbands(self):
+        return self.shape[2]
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
 
     def __repr__(self):
-        return f"SpectralImage(shape={self.shape}, dtype={self.dtype}, nbands={self.params.nbands}, nrows={self.params.nrows}, ncols={self.params.ncols}, bands={self.bands})"
+        band_range = "" if self.bands is None or len(self.bands) == 0 else f", bands={self.bands[0]:.1f}-{self.bands[-1]:.1f}nm"
+        return f"SpectralImage(shape={self.shape}{band_range}, processing_steps={self.processing_steps})"
+
+    def __getitem__(self, key):
+        '''
+        Select rows, columns and bands without copying data, e.g. img[100:200, 50:150] or img[:, :, 10:50].
+        Rows and columns must be contiguous slices, bands can be a slice, index array or boolean mask.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        new = self.copy()
+        for axis, sel in enumerate(key[:2]):
+            if not isinstance(sel, slice) or sel.step not in (None, 1):
+                raise IndexError("rows and columns can only be selected with contiguous slices")
+            start, stop = [(self._rows, self._cols)[axis][0] + i for i in sel.indices(self.shape[axis])[:2]]
+            if axis == 0:
+                new._rows = (start, max(start, stop))
+            else:
+                new._cols = (start, max(start, stop))
+        bands = key[2]
+        if not (isinstance(bands, slice) and bands == slice(None)):
+            if self._ops:
+                # bands after recorded operations are selected when the tile is computed
+                new._ops.append(lambda tile, window, bands=bands: tile[..., bands])
+            else:
+                band_idx = np.arange(self._source.shape[-1])[self._band_sel][bands]
+                new._band_sel = band_idx
+            if new.bands is not None:
+                new.bands = self.bands[bands]
+        return new
+
+    def select_bands(self, new_range):
+        '''
+        Returns a view with only the bands inside new_range = [min, max], without copying data.
+        '''
+        if self.bands is None:
+            raise ValueError("band centers are unknown")
+        new = self[:, :, (self.bands >= new_range[0]) & (self.bands <= new_range[1])]
+        new.processing_steps.append(f"Band selection {new_range[0]}-{new_range[1]}nm")
+        return new
+
+    def apply(self, step, func, bands=None):
+        '''
+        Returns a new SpectralImage with a recorded (lazy) pixel-wise operation.
+        input:
+            step: description of the operation added to processing_steps, str
+            func: func(tile, window) -> tile, see class docstring
+            bands: band centers after the operation if it changes the bands (optional)
+        output:
+            SpectralImage
+        '''
+        new = self.copy()
+        new._ops.append(func)
+        new.processing_steps.append(step)
+        if bands is not None:
+            new.bands = np.asarray(bands, dtype=np.float64)
+        return new
+
+    def _read(self, r0, r1):
+        '''
+        Reads and processes the rows r0 to r1-1 (source coordinates) of the selected columns.
+        '''
+        tile = get_array(self._source, bands=self._band_sel, rows=(r0, r1), cols=self._cols)
+        window = (r0, r1) + self._cols
+        for func in self._ops:
+            tile = func(tile, window)
+        return tile
+
+    def iter_tiles(self, tile_rows=64):
+        '''
+        Yields (r0, r1, tile) with the materialized rows r0 to r1-1 (image coordinates) of the image.
+        '''
+        for r0, r1 in _row_tiles(self.nrows, tile_rows):
+            yield r0, r1, self._read(self._rows[0] + r0, self._rows[0] + r1)
+
+    def to_array(self, out=None, tile_rows=64):
+        '''
+        Materialize the image tile by tile.
+        input:
+            out: None, path of a .npy file to memory-map, or preallocated float32 array of shape self.shape
+            tile_rows: number of rows per tile, int
+        output:
+            image as np.array (or np.memmap)
+        '''
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=self.shape)
+        for r0, r1, tile in self.iter_tiles(tile_rows):
+            out[r0:r1] = tile
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.to_array()
+        return arr if dtype is None else arr.astype(dtype)
+
+    def _matched(self, ref):
+        '''
+        Returns a reference (white/dark) as array with the same band selection and operations as this image, together with
+        the (row, col) offset of the reference in source coordinates for _ref_window.
+        References covering all columns and bands of the source keep all their columns, so averages over the reference
+        pixels do not depend on the column ROI of the image; crop them to a tile with _ref_window.
+        Other references are used as they are and are assumed to be aligned with the image.
+        '''
+        offset = (self._rows[0], self._cols[0])
+        if not isinstance(ref, SpectralImage):
+            ref = SpectralImage(ref) if isinstance(ref, sp.io.spyfile.SpyFile) or np.ndim(ref) == 3 else ref
+        if not isinstance(ref, SpectralImage):
+            return get_array(ref), offset
+        if ref._source.shape[1:] == self._source.shape[1:] and not ref._ops:
+            ref = ref.copy()
+            ref._cols, ref._band_sel, ref._ops, ref.bands = (0, self._source.shape[1]), self._band_sel, list(self._ops), self.bands
+            offset = (ref._rows[0], 0)
+        return ref.to_array(), offset
+
+    def interpolate(self, bands_range):
+        '''
+        Linear interpolation to 1nm steps in bands_range, see preprocessing.bands_lin_interpolation.
+        '''
+        if self.bands is None:
+            raise ValueError("band centers are unknown")
+        plan = get_interpolation_plan(self.bands, bands_range)
+        return self.apply(f"Interpolation to 1nm steps {bands_range[0]}-{bands_range[1]}nm",
+                          lambda tile, window: apply_interpolation_plan(tile, plan), bands=plan[2])
+
+    def calibrate(self, white_ref, dark_ref):
+        '''
+        Calibration with white and dark references, see preprocessing.calibrate_img.
+        '''
+        (white_ref, offset), (dark_ref, dark_offset) = self._matched(white_ref), self._matched(dark_ref)
+        # illumination spectrum averaged over all reference pixels like in calibrate_img, computed once for all tiles
+        E = np.mean(np.subtract(white_ref, dark_ref, dtype=np.float32), axis=-2, keepdims=True)
+        def calibrate(tile, window):
+            tile -= _ref_window(dark_ref, window, dark_offset)
+            tile /= _ref_window(E, window, offset)
+            return tile
+        return self.apply("Calibration", calibrate)
+
+    def l1_normalize(self):
+        return self.apply("Pixel-wise L1 normalization", lambda tile, window: l1_normalize(tile, inplace=True))
+
+    def smooth(self, window_size=5):
+        return self.apply(f"Spectral smoothing (window {window_size})", lambda tile, window: smooth_spectral(tile, window_size))
+
+    def to_absorbance(self):
+        return self.apply("Absorbance", lambda tile, window: to_absorbance(tile, inplace=True))
+
+
+def _ref_window(ref, window, offset):
+    '''
+    Crops a reference of shape (rows, cols, k) recorded at offset = (row, col) of the source to a tile window.
+    Single rows or columns are broadcast and not cropped.
+    '''
+    r0, r1, c0, c1 = window
+    if ref.ndim == 3 and ref.shape[0] > 1:
+        ref = ref[r0 - offset[0]:r1 - offset[0]]
+    if ref.ndim >= 2 and ref.shape[-2] > 1:
+        ref = ref[..., c0 - offset[1]:c1 - offset[1], :]
+    return ref
 
 
 def calibrage_img(img, white_ref, dark_ref, average_ref_pixels=False):
@@ -48,56 +253,63 @@ def calibrage_img(img, white_ref, dark_ref, average_ref_pixels=False):
         dark_ref: white reference, np.array or SpectralImage
         average_ref_pixels: if True, average the white and dark references over the input image before calibration
     output:
-        calibrated image as SpectralImage
+        calibrated image as SpectralImage (lazy)
     '''
-    img_cal = SpectralImage(img)
+    img = SpectralImage(img)
+    (white_ref, offset), (dark_ref, dark_offset) = img._matched(white_ref), img._matched(dark_ref)
     if average_ref_pixels:
-        img_cal.processing_steps.append("Calibration with averaged references")
+        step = "Calibration with averaged references"
         white_ref = np.mean(white_ref, axis=(0,1))
         dark_ref = np.mean(dark_ref, axis=(0,1))
     else:
-        img_cal.processing_steps.append("Calibration")
-    img_cal = np.divide(
-        np.subtract(img, dark_ref),
-        np.subtract(white_ref, dark_ref))
-    return 
+        step = "Calibration"
+    illumination = np.subtract(white_ref, dark_ref)
+    def calibrate(tile, window):
+        tile -= _ref_window(dark_ref, window, dark_offset)
+        tile /= _ref_window(illumination, window, offset)
+        return tile
+    return img.apply(step, calibrate)
 
 
-def normalize_band_wise(img, class_wise=False, gt_map=None):
+def normalize_band_wise(img, class_wise=False, gt_map=None, tile_rows=64):
     '''
-
+    Normalize the image band-wise to unit variance, (img - mean) / std + mean.
+    The statistics are computed in one streaming pass, the normalization itself is recorded lazily.
+    input:
+        img: image to normalize, SpectralImage
+        class_wise: if True, use the mean and std of each class, bool
+        gt_map: ground truth map of shape (rows, cols) or (rows, cols, 1) matching img
+    output:
+        normalized image as SpectralImage (lazy)
     '''
-    img_norm = SpectralImage(img)
-    if class_wise:
-        img_norm.processing_steps.append("Band-wise normalization with class-wise mean and std")
-        if gt_map is None:
-            raise ValueError("gt_map must be provided when class_wise is True")
-        classes = np.unique(gt_map)
-        for class_id in classes:
-            mask = np.where(gt_map[:,:,0] == class_id)
-            class_std = np.std(img_corr[mask], axis=0)
-            class_mean = np.mean(img_corr[mask], axis=0)
-            img_corr[mask] = (img[mask] - class_mean) / class_std + class_mean
-    else:
-        img_norm.processing_steps.append("Band-wise normalization with global mean and std")
-        img_norm = (img - np.mean(img, axis=(0,1))) / np.std(img, axis=(0,1)) + np.mean(img, axis=(0,1))
-    return 
-
-
-import spectral as sp
-import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
+    img = SpectralImage(img)
+    if class_wise and gt_map is None:
+        raise ValueError("gt_map must be provided when class_wise is True")
+    labels = np.zeros(img.shape[:2], dtype=np.int64) if not class_wise else np.asarray(get_array(gt_map)).reshape(img.shape[:2]).astype(np.int64)
+    stats = ClassStatistics(img.nbands)
+    for r0, r1, tile in img.iter_tiles(tile_rows):
+        stats.update(tile, labels[r0:r1])
+    class_mean = stats.mean.astype(np.float32)
+    class_std = stats.std.astype(np.float32)
+    row_offset, col_offset = img._rows[0], img._cols[0]
+    def normalize(tile, window):
+        r0, r1, c0, c1 = window
+        rows = stats.class_index(labels[r0 - row_offset:r1 - row_offset, c0 - col_offset:c1 - col_offset])
+        tile -= class_mean[rows]
+        tile /= class_std[rows]
+        tile += class_mean[rows]
+        return tile
+    step = "Band-wise normalization with class-wise mean and std" if class_wise else "Band-wise normalization with global mean and std"
+    return img.apply(step, normalize)
 
-data_folder = "helicoid/005-01"
-img = sp.open_image(data_folder + "/raw.hdr")
 
-test_img = SpectralImage(img)
-print(test_img.nrows)
-print(np.mean(test_img))
-print(type(test_img))
-norm = normalize_band_wise(test_img) 
-print(type(norm))
+if __name__ == "__main__":
+    data_folder = "helicoid/005-01"
+    img = SpectralImage.open_image(data_folder + "/raw.hdr")
+    white_ref = SpectralImage.open_image(data_folder + "/whiteReference.hdr")
+    dark_ref = SpectralImage.open_image(data_folder + "/darkReference.hdr")
 
-for i in range(4):
-    img = i
\ No newline at end of file
+    test_img = calibrage_img(img.select_bands([520, 900]), white_ref, dark_ref)
+    norm = normalize_band_wise(test_img)
+    print(norm)
+    print(np.mean(norm[:100, :100].to_array()))
@@ -0,0 +1,101 @@
+import numpy as np
+from skimage.segmentation import slic
+
+from preprocessing import ClassStatistics
+from unmixing_algorithms import OSPUnmixer
+
+
+def reduce_spectra(abs, n_components=8, n_samples=20000, seed=0):
+    '''
+    Projects the spectra onto their first principal components, estimated from a random subset of pixels.
+    input:
+        abs: absorbance image, np.array of shape (m,l,k)
+        n_components: number of principal components, int
+        n_samples: number of pixels used to estimate the components, int
+    output:
+        reduced image, np.array of shape (m,l,n_components)
+    '''
+    spectra = abs.reshape(-1, abs.shape[-1])
+    rng = np.random.default_rng(seed)
+    sample = spectra[rng.choice(spectra.shape[0], min(n_samples, spectra.shape[0]), replace=False)].astype(np.float64)
+    mean = sample.mean(axis=0)
+    _, _, Vt = np.linalg.svd(sample - mean, full_matrices=False)
+    components = Vt[:n_components].astype(np.float32)
+    reduced = (spectra - mean.astype(np.float32)) @ components.T
+    return reduced.reshape(abs.shape[:-1] + (components.shape[0],))
+
+def segment_superpixels(abs, n_segments=2000, compactness=0.1, n_components=8):
+    '''
+    Segments the absorbance image into spectrally homogeneous superpixels with SLIC on its first principal components.
+    input:
+        abs: absorbance image, np.array of shape (m,l,k)
+        n_segments: approximate number of superpixels, int
+        compactness: trade-off between spectral similarity and spatial proximity, float (in units of the reduced spectra)
+        n_components: number of principal components SLIC works on, None for the full spectra
+    output:
+        labels: superpixel of every pixel, np.array of shape (m,l)
+    '''
+    features = abs if n_components is None else reduce_spectra(abs, n_components)
+    return slic(features, n_segments=n_segments, compactness=compactness, channel_axis=-1, start_label=0)
+
+def superpixel_means(abs, labels):
+    '''
+    Mean spectrum of every superpixel.
+    output:
+        means: np.array of shape (n_superpixels, k)
+        index: row of means for every pixel, np.array of shape (m,l)
+    '''
+    stats = ClassStatistics(abs.shape[-1]).update(abs, labels)
+    return stats.mean, stats.class_index(np.asarray(labels).reshape(-1)).reshape(labels.shape)
+
+def superpixel_unmix(abs, unmixer, labels=None, refine_threshold=None, **segment_kwargs):
+    '''
+    Superpixel-level unmixing for fast previews: only the mean spectra of the superpixels are unmixed and the abundances
+    are painted back at full resolution. Pixels whose residual norm with the superpixel abundances is above
+    refine_threshold are unmixed individually.
+    input:
+        abs: absorbance image, np.array of shape (m,l,k)
+        unmixer: fitted LSUnmixer, NNLSUnmixer or FCLSUnmixer
+        labels: superpixel labels of shape (m,l), computed with segment_superpixels(abs, **segment_kwargs) if None
+        refine_threshold: residual norm above which pixels are unmixed individually, float (optional)
+    output:
+        c: estimated abundances, np.array of shape (m,l,n)
+        residual: residual norm per pixel, np.array of shape (m,l)
+        labels: superpixel labels, np.array of shape (m,l)
+        refined: pixels that were unmixed individually, bool np.array of shape (m,l)
+    '''
+    if isinstance(unmixer, OSPUnmixer):
+        raise ValueError("use superpixel_detect for OSP heatmaps")
+    if labels is None:
+        labels = segment_superpixels(abs, **segment_kwargs)
+    means, index = superpixel_means(abs, labels)
+    c = unmixer.abundances(means)[index]
+    residual = np.linalg.norm(c.astype(abs.dtype) @ unmixer.M.T.astype(abs.dtype) - abs, axis=-1)
+    refined = np.zeros(labels.shape, dtype=bool)
+    if refine_threshold is not None:
+        refined = residual > refine_threshold
+        if refined.any():
+            c[refined] = unmixer.abundances(abs[refined])
+            residual[refined] = np.linalg.norm(c[refined] @ unmixer.M.T - abs[refined], axis=-1)
+    return c, residual, labels, refined
+
+def superpixel_detect(abs, detector, labels=None, **segment_kwargs):
+    '''
+    Superpixel-level detection for fast previews: detector is applied to the mean spectra of the superpixels only
+    and the heatmaps are painted back at full resolution.
+    For icem, pass the correlation matrix R of the full image (e.g. from CorrelationAccumulator), otherwise it is
+    estimated from the superpixel means.
+    input:
+        abs: absorbance image, np.array of shape (m,l,k)
+        detector: function mapping spectra of shape (N,k) to heatmaps of shape (N,...),
+                  e.g. lambda s: icem(s, t, lmda, R=R), lambda s: osp(s, endmembers_proj, t) or OSPUnmixer(...).fit(M).abundances
+        labels: superpixel labels of shape (m,l), computed with segment_superpixels(abs, **segment_kwargs) if None
+    output:
+        heatmap: np.array of shape (m,l,...)
+        labels: superpixel labels, np.array of shape (m,l)
+    '''
+    if labels is None:
+        labels = segment_superpixels(abs, **segment_kwargs)
+    means, index = superpixel_means(abs, labels)
+    heatmap = np.asarray(detector(means))
+    return heatmap[index], labels
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pytest
+import scipy.optimize
+from scipy.ndimage import gaussian_filter
+
+from unmixing_algorithms import (nnls_batched, load_spectra_library, unmix_multiresolution,
+                                 NNLSUnmixer, FCLSUnmixer, OSPUnmixer, SUnSALUnmixer, Unmixer)
+
+MC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mc_sim", "spectra_mc")
+
+
+def random_problem(n, n_pixels=200, seed=0):
+    rng = np.random.default_rng(seed)
+    M = np.abs(rng.normal(size=(381, n)))
+    C = np.abs(rng.normal(size=(n_pixels, n))) * (rng.random((n_pixels, n)) < 0.2)
+    return M, C @ M.T + rng.normal(0, 0.1, (n_pixels, 381))
+
+
+def test_nnls_batched_large_library():
+    # more than 64 endmembers, the passive sets do not fit into one int64 code
+    M, Y = random_problem(70)
+    X, _ = nnls_batched(M, Y)
+    X_scipy = np.array([scipy.optimize.nnls(M, y)[0] for y in Y])
+    assert np.abs(X - X_scipy).max() < 1e-8
+
+
+def test_inverse_cache_is_bounded(tmp_path):
+    M, Y = random_problem(12, 2000)
+    c = FCLSUnmixer(max_factors=None).fit(M).abundances(Y)
+    unmixer = FCLSUnmixer(max_factors=10).fit(M)
+    assert np.abs(unmixer.abundances(Y) - c).max() < 1e-10
+    assert len(unmixer.factors) == 10
+    unmixer.save(tmp_path / "unmixer.npz")
+    loaded = Unmixer.load(tmp_path / "unmixer.npz")
+    assert len(loaded.factors) == 10 and loaded.factors.max_size == 10
+    assert np.abs(loaded.abundances(Y) - c).max() < 1e-10
+
+
+def smooth_cube(M, shape, noise=1e-5, seed=0):
+    rng = np.random.default_rng(seed)
+    C = np.stack([gaussian_filter(rng.random(shape), 8) for _ in range(M.shape[1])], axis=-1)
+    C[C < np.quantile(C, 0.2)] = 0
+    C /= C.sum(axis=-1, keepdims=True)
+    return C @ M.T + rng.normal(0, noise, shape + (M.shape[0],))
+
+
+@pytest.mark.parametrize("unmixer_class", [NNLSUnmixer, FCLSUnmixer])
+@pytest.mark.parametrize("shape", [(64, 64), (37, 29)])
+def test_multiresolution_skips_smooth_pixels(unmixer_class, shape):
+    M, _ = load_spectra_library(MC_FOLDER)
+    M = M[:, :6]
+    abs = smooth_cube(M, shape)
+    c_full = unmixer_class().fit(M).abundances(abs)
+    c, bound, n_solved = unmix_multiresolution(unmixer_class().fit(M), abs)
+    assert n_solved[-1] < shape[0] * shape[1] / 2
+    error = np.linalg.norm(c - c_full, axis=-1)
+    assert bound.max() <= 1e-3 and np.all(error <= bound + 1e-9)
+    c, _, _ = unmix_multiresolution(unmixer_class().fit(M), abs, threshold=0)
+    assert np.abs(c - c_full).max() < 1e-9
+
+
+@pytest.mark.parametrize("sum_to_one", [False, True])
+def test_sunsal_defaults_converge_on_mc_library(sum_to_one):
+    M, _ = load_spectra_library(MC_FOLDER)
+    rng = np.random.default_rng(0)
+    C = np.abs(rng.normal(size=(2000, M.shape[1]))) * (rng.random((2000, M.shape[1])) < 0.4)
+    if sum_to_one:
+        C /= np.maximum(C.sum(axis=1, keepdims=True), 1e-12)
+    Y = C @ M.T + rng.normal(0, 1e-2, (2000, M.shape[0]))
+    unmixer = SUnSALUnmixer(sum_to_one=sum_to_one).fit(M)
+    c, n_iter = unmixer.solve(Y)
+    assert np.mean(n_iter < unmixer.max_iter) >= 0.99
+    c_exact = (FCLSUnmixer() if sum_to_one else NNLSUnmixer()).fit(M).abundances(Y)
+    assert np.abs(c - c_exact).max() < 5e-3
+
+
+def test_osp_transform_returns_pair():
+    M, Y = random_problem(5, 100)
+    unmixer = OSPUnmixer().fit(M)
+    c, err = unmixer.transform(Y)
+    assert err is None
+    np.testing.assert_array_equal(c, unmixer.abundances(Y))
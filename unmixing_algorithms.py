@@ -1,7 +1,18 @@
+import os
+import time
+import warnings
 import numpy as np
+from collections import OrderedDict
+import torch
 import scipy
+import scipy.linalg
+import scipy.sparse
 from cvxopt import matrix, solvers
 from tqdm import tqdm
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from preprocessing import get_array, leave_one_out, osp_filters, _open_output, _row_tiles
 
 def unmix_LS_unconstrained(M, abs):
     '''
@@ -13,43 +24,994 @@ def unmix_LS_unconstrained(M, abs):
         c: estimated abundances, np.array of shape (...,n) where ... is the number of pixels
         err: difference spectrum, np.array of shape (...,k) where ... is the number of pixels
     '''
-    M_inv = np.linalg.pinv(M)
-    c = np.einsum("ij,...j->...i", M_inv, abs)
-    err = np.einsum("kn,...n->...k", M, c) - abs
-    return c, err
+    return LSUnmixer().fit(M).transform(abs)
+
+def _is_torch(x):
+    return isinstance(x, torch.Tensor)
+
+def _to_numpy(x):
+    '''
+    Returns CPU torch tensors as numpy arrays (without copy), other inputs unchanged.
+    '''
+    if _is_torch(x):
+        if x.device.type != "cpu":
+            raise ValueError("only CPU tensors are supported")
+        return x.detach().numpy()
+    return np.asarray(x)
+
+def _pattern_codes(P):
+    '''
+    Encodes the rows of a boolean passive set matrix (N,n) as packed bytes (one np.void per row, for any n),
+    so pixels with the same passive set can be grouped.
+    '''
+    packed = np.ascontiguousarray(np.packbits(P, axis=1))
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+
+class InverseCache(OrderedDict):
+    '''
+    Least recently used cache of the passive set inverses of nnls_batched, keyed by the packed passive set (bytes).
+    At most max_size inverses of shape (n,n) are kept, None for no limit, 0 disables the cache.
+    '''
+    def __init__(self, max_size=1024):
+        super().__init__()
+        self.max_size = max_size
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(entries={len(self)}, max_size={self.max_size})"
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while self.max_size is not None and len(self) > self.max_size:
+            self.popitem(last=False)
+
+def _passive_inverses(G, P):
+    '''
+    Inverses of the Gram matrix restricted to passive sets, padded with zeros to shape (n,n).
+    input:
+        G: Gram matrix M^T M, shape (n,n)
+        P: distinct passive sets, bool array of shape (u,n)
+    output:
+        inverses, shape (u,n,n)
+    '''
+    mask = P[:, :, None] & P[:, None, :]
+    # inactive endmembers get an identity block, so the inverse of the passive block can be taken for all sets at once
+    G_P = np.where(mask, G, np.eye(G.shape[0]))
+    try:
+        G_inv = np.linalg.inv(G_P)
+    except np.linalg.LinAlgError:
+        # singular sub problem (collinear endmembers), fall back to the pseudoinverse
+        G_inv = np.linalg.pinv(G_P, hermitian=True)
+    return np.where(mask, G_inv, 0)
+
+def _solve_passive(G, B, P, factors, sum_to_one=False):
+    '''
+    Solves the unconstrained (or sum-to-one constrained) least squares problems restricted to the passive sets,
+    with one inverse of the sub Gram matrix per distinct passive set.
+    input:
+        G: Gram matrix M^T M, shape (n,n)
+        B: M^T y of all pixels, shape (N,n)
+        P: passive sets, bool array of shape (N,n)
+        factors: dict or InverseCache of the inverses per packed passive set, filled during the solve
+        sum_to_one: if True the solution satisfies sum(x) = 1
+    output:
+        S: solutions, zero outside the passive sets, shape (N,n)
+        nu: Lagrange multipliers of the sum-to-one constraint (zeros if sum_to_one is False), shape (N,)
+    '''
+    uniques, first, inverse = np.unique(_pattern_codes(P), return_index=True, return_inverse=True)
+    keys = [code.tobytes() for code in uniques]
+    new = np.array([key not in factors for key in keys], dtype=bool)
+    G_inv = np.empty((len(keys),) + G.shape)
+    for j in np.flatnonzero(~new):
+        G_inv[j] = factors[keys[j]]
+    if new.any():
+        # the inverses of this solve are kept locally, so evictions from a bounded cache do not affect it
+        G_inv[new] = _passive_inverses(G, P[first[new]])
+        for j in np.flatnonzero(new):
+            factors[keys[j]] = G_inv[j].copy()
+    S = np.einsum("pij,pj->pi", G_inv[inverse], B)
+    # one step of iterative refinement, the inverse of an ill-conditioned Gram matrix loses accuracy
+    S += np.einsum("pij,pj->pi", G_inv[inverse], B - S @ G)
+    nu = np.zeros(B.shape[0])
+    if sum_to_one:
+        # x = G^-1 (b - nu 1) with nu chosen such that sum(x) = 1
+        G_inv_1 = G_inv.sum(axis=2)[inverse]
+        nu = (S.sum(axis=1) - 1) / G_inv_1.sum(axis=1)
+        S -= G_inv_1 * nu[:, None]
+    return S, nu
+
+def _gradient_tol(M, Y, tol=None):
+    '''
+    Per pixel tolerance on the gradient of the active set method, default 10*max(k,n)*eps*||M||_1*||y||_inf.
+    '''
+    if tol is None:
+        tol = 10 * max(M.shape) * np.finfo(np.float64).eps * np.linalg.norm(M, 1) * np.maximum(np.abs(Y).max(axis=1, initial=0), 1)
+    return np.broadcast_to(np.asarray(tol, dtype=np.float64), (Y.shape[0],))
+
+def nnls_batched(M, Y, tol=None, max_iter=None, sum_to_one=False, G=None, factors=None, init=None, lambda_l1=0.0):
+    '''
+    Non-negative least squares for many pixels at once, min ||M x - y|| s.t. x >= 0 (and sum(x) = 1 if sum_to_one),
+    using the active set method of Lawson and Hanson in the batched form of Van Benthem and Keenan (fast combinatorial NNLS):
+    all pixels share the Gram matrix M^T M, and pixels with the same passive set are solved with one factorization.
+    The abundances agree with scipy.optimize.nnls up to the conditioning of M^T M, typically |x - x_scipy| < 1e-8 * max|x|.
+    input:
+        M: endmember spectra matrix, np.array of shape (k, n)
+        Y: spectra, np.array of shape (N, k)
+        tol: tolerance on the gradient for adding an endmember to the passive set, default 10*max(k,n)*eps*||M||_1*||y||_inf per pixel
+        max_iter: maximum number of outer iterations, default 3*n
+        sum_to_one: if True the abundances additionally sum to one (fully constrained least squares)
+        G: precomputed Gram matrix M^T M (optional)
+        factors: dict or InverseCache of inverses per passive set, reused and extended across calls (optional)
+        init: initial passive sets for a warm start, e.g. the supports of neighbouring solutions, bool array of shape (N, n) (optional)
+        lambda_l1: weight of an L1 penalty lambda_l1 ||x||_1, a linear term for x >= 0 (constant if sum_to_one), float
+    output:
+        X: abundances, np.array of shape (N, n)
+        n_iter: number of passive set solves per pixel, np.array of shape (N,)
+    '''
+    M = np.asarray(M, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    k, n = M.shape
+    N = Y.shape[0]
+    G = M.T @ M if G is None else G
+    B = Y @ M - lambda_l1
+    tol = _gradient_tol(M, Y, tol)
+    max_iter = 3 * n if max_iter is None else max_iter
+    factors = {} if factors is None else factors
 
-def unmix_LS_nonnegative(M, abs):
+    P = np.zeros((N, n), dtype=bool) if init is None else np.array(init, dtype=bool)
+    X = np.zeros((N, n))
+    nu = np.zeros(N)
+    n_iter = np.zeros(N, dtype=np.int64)
+    # warm start: drop endmembers with negative abundances from the initial passive sets until the solution is feasible
+    warm = np.flatnonzero(P.any(axis=1))
+    while warm.size:
+        S, nu[warm] = _solve_passive(G, B[warm], P[warm], factors, sum_to_one)
+        n_iter[warm] += 1
+        negative = P[warm] & (S <= 0)
+        bad = negative.any(axis=1)
+        X[warm[~bad]] = S[~bad]
+        P[warm[bad]] &= ~negative[bad]
+        warm = warm[bad]
+    todo = np.zeros(0, dtype=np.int64)
+    if sum_to_one:
+        # cold start where no (feasible) passive set is left: all endmembers passive with equal abundances
+        todo = np.flatnonzero(~P.any(axis=1))
+        P[todo] = True
+        X[todo] = 1.0 / n
+    # converged pixels do not change anymore, only the remaining ones are checked
+    active = np.arange(N)
+    for it in range(max_iter + 1):
+        if it > 0:
+            W = B[active] - X[active] @ G - nu[active, None]
+            W[P[active]] = -np.inf
+            unconverged = W.max(axis=1, initial=-np.inf) > tol[active]
+            active, W = active[unconverged], W[unconverged]
+            todo = active
+            if todo.size == 0:
+                break
+            # add the endmember with the largest gradient to the passive set
+            P[todo, W.argmax(axis=1)] = True
+        # inner loop: solve on the passive sets and move back into the feasible region where needed
+        inner = todo
+        while inner.size:
+            S, nu_inner = _solve_passive(G, B[inner], P[inner], factors, sum_to_one)
+            nu[inner] = nu_inner
+            n_iter[inner] += 1
+            P_i, X_i = P[inner], X[inner]
+            infeasible = P_i & (S <= 0)
+            bad = infeasible.any(axis=1)
+            good = ~bad
+            X[inner[good]] = S[good]
+            inner, S, P_i, X_i, infeasible = inner[bad], S[bad], P_i[bad], X_i[bad], infeasible[bad]
+            if inner.size == 0:
+                break
+            # largest step towards S that keeps all passive abundances non-negative
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.where(infeasible, X_i / (X_i - S), np.inf)
+            alpha = ratio.min(axis=1, keepdims=True)
+            X_i = X_i + alpha * (S - X_i)
+            remove = P_i & (X_i <= tol[inner, None])
+            # the endmember that limited the step always leaves the passive set
+            remove[np.arange(inner.size), ratio.argmin(axis=1)] = True
+            X_i[remove] = 0
+            P[inner] = P_i & ~remove
+            X[inner] = X_i
+    return X, n_iter
+
+def unmix_LS_nonnegative(M, abs, method="batched", chunk_size=65536, tol=None, workers=1):
     '''
     Unmixing algorithm using least squares with non-negative constraints.
     input:
         M: endmember spectra matrix, np.array of shape (k, n) where k is the number of spectral bands and n is the number of endmembers
-        abs: absorbance spectra, np.array of shape (k) or (m,l,k) where m and l are the number of pixels
+        abs: absorbance spectra, np.array of shape (k), (N,k) or (m,l,k) where N, m and l are the number of pixels
+        method: "batched" for nnls_batched on chunks of pixels, "scipy" for scipy.optimize.nnls per pixel
+        chunk_size: number of pixels solved at once by the batched solver
+        tol: gradient tolerance of nnls_batched (optional)
+        workers: number of worker processes for the batched solver, see unmix_tiled
     output:
-        c: estimated abundances, np.array of shape (n) or (m,l,n)
-        err: difference spectrum, np.array of shape (k) or (m,l,k)
+        c: estimated abundances, np.array of shape (n), (N,n) or (m,l,n)
+        err: difference spectrum, np.array of shape (k), (N,k) or (m,l,k)
     '''
+    if method == "batched":
+        unmixer = NNLSUnmixer(chunk_size, tol).fit(M)
+        if workers > 1 and abs.ndim > 1:
+            cube = abs.reshape(abs.shape[0], -1, abs.shape[-1])
+            # float64 outputs like the serial path
+            c = np.empty(cube.shape[:-1] + (M.shape[1],))
+            err = np.empty(cube.shape)
+            unmix_tiled(unmixer, cube, out=c, residual="full", residual_out=err,
+                        tile_rows=_parallel_tile_rows(abs.shape[0], chunk_size, workers), workers=workers)
+            return c.reshape(abs.shape[:-1] + (M.shape[1],)), err.reshape(abs.shape)
+        return unmixer.transform(abs)
+    elif method != "scipy":
+        raise ValueError(f"Unknown method {method}")
     n = M.shape[1]
-    if abs.ndim == 1:
-        c, _ = scipy.optimize.nnls(M, abs)
-    if abs.ndim == 3:
-        m, l, k = abs.shape
-        c = np.zeros((m,l,n))
-        for i in tqdm(range(m)):
-            for j in range(l):
-                c[i,j,:], _ = scipy.optimize.nnls(M, abs[i,j,:])
+    spectra = abs.reshape(-1, abs.shape[-1])
+    c = np.zeros((spectra.shape[0], n))
+    for i in tqdm(range(spectra.shape[0])):
+        c[i], _ = scipy.optimize.nnls(M, spectra[i])
+    c = c.reshape(abs.shape[:-1] + (n,))
     err = np.einsum("kn,...n->...k", M, c) - abs
     return c, err
 
 
+class Unmixer:
+    '''
+    Base class of the fitted unmixers. fit(M) precomputes everything that only depends on the endmember matrix
+    (Gram matrix, pseudoinverse, factorizations), transform(abs) applies it to a spectrum, a list of spectra or a cube.
+    Fitted unmixers are saved to a .npz file and loaded with Unmixer.load, so batch jobs do not refactorize
+    the endmember matrices for every patient.
+
+    usage:
+        unmixer = FCLSUnmixer().fit(M)
+        unmixer.save("unmixer_mc.npz")
+        c, err = Unmixer.load("unmixer_mc.npz").transform(absorbance)
+    '''
+    def __init__(self, chunk_size=65536):
+        self.chunk_size = chunk_size
+        self.M = None
+
+    def __repr__(self):
+        shape = None if self.M is None else self.M.shape
+        return f"{self.__class__.__name__}(M={shape}, chunk_size={self.chunk_size})"
+
+    def fit(self, M):
+        '''
+        input:
+            M: endmember spectra matrix, np.array of shape (k, n) where k is the number of spectral bands and n is the number of endmembers
+        output:
+            self
+        '''
+        self.M = np.asarray(M, dtype=np.float64)
+        self.G = self.M.T @ self.M
+        return self
+
+    def _check_fitted(self):
+        if self.M is None:
+            raise RuntimeError(f"{self.__class__.__name__} is not fitted, call fit(M) first")
+
+    def _transform_spectra(self, spectra):
+        '''
+        Abundances of a chunk of spectra (N,k), shape (N,n).
+        '''
+        raise NotImplementedError
+
+    def abundances(self, abs):
+        '''
+        Estimated abundances only, without the difference spectrum.
+        input:
+            abs: absorbance spectra, np.array of shape (...,k)
+        output:
+            c: estimated abundances, np.array of shape (...,n)
+        '''
+        self._check_fitted()
+        spectra = abs.reshape(-1, abs.shape[-1])
+        c = np.zeros((spectra.shape[0], self.M.shape[1]))
+        for start in range(0, spectra.shape[0], self.chunk_size):
+            c[start:start+self.chunk_size] = self._transform_spectra(spectra[start:start+self.chunk_size])
+        return c.reshape(abs.shape[:-1] + (self.M.shape[1],))
+
+    def transform(self, abs):
+        '''
+        input:
+            abs: absorbance spectra, np.array of shape (...,k) where ... is the number of pixels
+        output:
+            c: estimated abundances, np.array of shape (...,n)
+            err: difference spectrum, np.array of shape (...,k), None for OSPUnmixer
+        '''
+        c = self.abundances(abs)
+        err = np.einsum("kn,...n->...k", self.M, c) - abs
+        return c, err
+
+    def _state(self):
+        return {"M": self.M, "G": self.G, "chunk_size": self.chunk_size}
+
+    def _set_state(self, state):
+        self.M, self.G, self.chunk_size = state["M"], state["G"], int(state["chunk_size"])
+
+    def save(self, path):
+        '''
+        Save the fitted unmixer to a .npz file.
+        '''
+        self._check_fitted()
+        np.savez(path, unmixer=self.__class__.__name__, **self._state())
+
+    @staticmethod
+    def load(path):
+        '''
+        Load an unmixer saved with save, the class is restored from the file.
+        '''
+        data = np.load(path)
+        unmixer = _UNMIXERS[str(data["unmixer"])]()
+        unmixer._set_state({key: data[key] for key in data.files})
+        return unmixer
+
+
+class LSUnmixer(Unmixer):
+    '''
+    Least squares unmixing without constraints, the pseudoinverse of M is computed once in fit.
+    '''
+    def fit(self, M):
+        super().fit(M)
+        self.M_inv = np.linalg.pinv(self.M)
+        return self
+
+    def _transform_spectra(self, spectra):
+        return spectra @ self.M_inv.T
+
+    def abundances(self, abs):
+        self._check_fitted()
+        return np.einsum("ij,...j->...i", self.M_inv, abs)
+
+    def _state(self):
+        return {**super()._state(), "M_inv": self.M_inv}
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.M_inv = state["M_inv"]
+
+
+class NNLSUnmixer(Unmixer):
+    '''
+    Least squares unmixing with non-negative constraints using nnls_batched. The Gram matrix and the inverses
+    of its sub matrices for the max_factors most recently used passive sets are kept (and saved), so later images reuse them.
+    '''
+    sum_to_one = False
+
+    def __init__(self, chunk_size=65536, tol=None, max_factors=1024):
+        super().__init__(chunk_size)
+        self.tol = tol
+        self.factors = InverseCache(max_factors)
+
+    def fit(self, M):
+        super().fit(M)
+        self.factors = InverseCache(self.factors.max_size)
+        return self
+
+    def _transform_spectra(self, spectra):
+        c, _ = nnls_batched(self.M, spectra, tol=self.tol, sum_to_one=self.sum_to_one, G=self.G, factors=self.factors)
+        return c
+
+    def kkt_violation(self, c, spectra):
+        '''
+        Violation of the optimality conditions of candidate abundances, zero (up to rounding) for the exact solution.
+        input:
+            c: candidate abundances, np.array of shape (N,n)
+            spectra: spectra, np.array of shape (N,k)
+        output:
+            violation: largest gradient component that prevents optimality per pixel, np.array of shape (N,)
+        '''
+        W = np.asarray(spectra, dtype=np.float64) @ self.M - c @ self.G
+        support = c > 0
+        if self.sum_to_one:
+            # multiplier of the sum-to-one constraint, the gradient is constant on the support at the optimum
+            nu = np.where(support, W, 0).sum(axis=1) / np.maximum(support.sum(axis=1), 1)
+            W = W - nu[:, None]
+        violation = np.where(support, np.abs(W), np.maximum(W, 0)).max(axis=1)
+        violation = np.maximum(violation, np.maximum(-c, 0).max(axis=1))
+        if self.sum_to_one:
+            violation = np.maximum(violation, np.abs(c.sum(axis=1) - 1))
+        return violation
+
+    def abundances_warm(self, abs, fit_factor=10.0, block_rows=16):
+        '''
+        Abundances of a cube solved in blocks of rows in scan order. Every pixel of a block is warm-started with the passive set
+        of the pixel in the same column of the last row of the previous block, so one nnls_batched call still solves
+        block_rows * l pixels at once. Neighbouring tissue pixels mostly share the same endmembers, so the solver often only
+        confirms the passive set. Fewer passive set solves do not always mean less wall time: on a smooth 200x200 cube with
+        the MC library the warm NNLS solve took about as long as the cold one and the warm FCLS solve was slower, so compare
+        seconds with the time of abundances before switching.
+        A pixel falls back to a cold start if the neighbour's solution does not fit it, i.e. its residual on this pixel
+        is larger than fit_factor times its residual on its own pixel.
+        input:
+            abs: absorbance cube, np.array of shape (m,l,k)
+            fit_factor: residual ratio above which the neighbour's solution is not used, float
+            block_rows: number of rows solved per call, int
+        output:
+            c: estimated abundances, np.array of shape (m,l,n)
+            n_iter: number of passive set solves per pixel, compare with n_iter of a cold nnls_batched, np.array of shape (m,l)
+            warm: pixels that were warm-started, bool np.array of shape (m,l)
+            seconds: wall time of the solve, compare with the time of abundances, float
+        '''
+        self._check_fitted()
+        t0 = time.perf_counter()
+        m, l, k = abs.shape
+        n = self.M.shape[1]
+        c = np.zeros((m, l, n))
+        n_iter = np.zeros((m, l), dtype=np.int64)
+        warm = np.zeros((m, l), dtype=bool)
+        c_prev, residual_prev = None, None
+        for r0 in range(0, m, block_rows):
+            r1 = min(r0 + block_rows, m)
+            y = np.asarray(abs[r0:r1], dtype=np.float64)
+            init = None
+            if c_prev is not None:
+                residual_nb = np.linalg.norm(c_prev @ self.M.T - y, axis=-1)
+                warm[r0:r1] = residual_nb <= fit_factor * np.maximum(residual_prev, np.finfo(np.float64).tiny)
+                init = ((c_prev > 0) & warm[r0:r1, :, None]).reshape(-1, n)
+            c_block, n_iter_block = nnls_batched(self.M, y.reshape(-1, k), tol=self.tol, sum_to_one=self.sum_to_one,
+                                                 G=self.G, factors=self.factors, init=init)
+            c[r0:r1] = c_block.reshape(r1 - r0, l, n)
+            n_iter[r0:r1] = n_iter_block.reshape(r1 - r0, l)
+            c_prev = c[r1-1]
+            residual_prev = np.linalg.norm(c_prev @ self.M.T - y[-1], axis=-1)
+        return c, n_iter, warm, time.perf_counter() - t0
+
+    def _state(self):
+        n_bytes = -(-self.G.shape[0] // 8)
+        codes = np.array([np.frombuffer(key, dtype=np.uint8) for key in self.factors.keys()], dtype=np.uint8).reshape(-1, n_bytes)
+        inverses = np.stack(list(self.factors.values())) if self.factors else np.zeros((0,) + self.G.shape)
+        state = {**super()._state(), "codes": codes, "inverses": inverses,
+                 "max_factors": -1 if self.factors.max_size is None else self.factors.max_size}
+        if self.tol is not None:
+            state["tol"] = self.tol
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.tol = state.get("tol")
+        max_factors = int(state["max_factors"])
+        self.factors = InverseCache(None if max_factors < 0 else max_factors)
+        for code, G_inv in zip(state["codes"], state["inverses"]):
+            self.factors[code.tobytes()] = G_inv
+
+
+class FCLSUnmixer(NNLSUnmixer):
+    '''
+    Fully constrained least squares unmixing (non-negative and sum-to-one) using nnls_batched.
+    '''
+    sum_to_one = True
+
+
+class OSPUnmixer(Unmixer):
+    '''
+    Orthogonal subspace projection for every endmember: the spectra are projected onto the subspace orthogonal to
+    all other endmembers and correlated with the endmember, as osp in preprocessing.py does for one target.
+    The n filter vectors are computed once in fit, transform returns the n heatmaps.
+    '''
+    def fit(self, M):
+        super().fit(M)
+        self.W = osp_filters(*leave_one_out(self.M))
+        return self
+
+    def _transform_spectra(self, spectra):
+        return spectra @ self.W.T
+
+    def transform(self, abs):
+        '''
+        input:
+            abs: absorbance spectra, np.array of shape (...,k)
+        output:
+            c: heatmaps, np.array of shape (...,n)
+            err: None, the heatmaps are not abundances, so there is no difference spectrum
+        '''
+        return self.abundances(abs), None
+
+    def _state(self):
+        return {**super()._state(), "W": self.W}
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.W = state["W"]
+
+
+def _project_simplex(X):
+    '''
+    Euclidean projection of every row of X onto the probability simplex {x >= 0, sum(x) = 1} (Duchi et al. 2008).
+    '''
+    U = -np.sort(-X, axis=1)
+    css = np.cumsum(U, axis=1) - 1
+    ind = np.arange(1, X.shape[1] + 1)
+    rho = np.count_nonzero(U - css / ind > 0, axis=1)
+    theta = css[np.arange(X.shape[0]), rho - 1] / rho
+    return np.maximum(X - theta[:, None], 0)
+
+
+class SUnSALUnmixer(Unmixer):
+    '''
+    Sparse unmixing by variable splitting and augmented Lagrangian (SUnSAL, Bioucas-Dias and Figueiredo 2010):
+    min 1/2 ||M x - y||^2 + lambda_l1 ||x||_1 s.t. x >= 0 (and sum(x) = 1 if sum_to_one), solved with ADMM for all pixels
+    of a chunk at once. The only factorization, the eigendecomposition M^T M = V diag(e) V^T, is computed once in fit and
+    shared by all pixels and iterations: (M^T M + mu I)^-1 = V diag(1/(e + mu)) V^T for any mu, so every pixel adapts its
+    own penalty mu by residual balancing (Boyd et al. 2011, 3.4.1) at the cost of two (N,n) x (n,n) products per iteration,
+    even for libraries with hundreds of columns (see load_spectra_library).
+    With the defaults (lambda_l1 = 0) the abundances agree with NNLSUnmixer/FCLSUnmixer to about 1e-3 (at most ~5e-3)
+    on the ill-conditioned mc_sim/spectra_mc library (cond(M^T M) ~ 1e6), where ADMM converges slowly, and more closely
+    for better conditioned libraries; lower tol for more accurate abundances. Pixels that do not converge within max_iter
+    iterations are finished with nnls_batched, warm-started from the ADMM support.
+    '''
+    def __init__(self, lambda_l1=0.0, mu=None, sum_to_one=False, max_iter=5000, tol=1e-5, check_every=10, chunk_size=65536):
+        '''
+        input:
+            lambda_l1: weight of the L1 penalty, float
+            mu: initial ADMM penalty parameter, default sqrt(e_min * e_max) of the eigenvalues of M^T M
+            sum_to_one: if True the abundances additionally sum to one
+            max_iter: maximum number of ADMM iterations, int
+            tol: tolerance on the primal and dual residuals relative to the norms of the abundances and dual variables, float
+            check_every: number of iterations between convergence checks and mu updates, int
+        '''
+        super().__init__(chunk_size)
+        self.check_every = check_every
+        self.lambda_l1 = lambda_l1
+        self.mu = mu
+        self.sum_to_one = sum_to_one
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def __repr__(self):
+        shape = None if self.M is None else self.M.shape
+        return f"{self.__class__.__name__}(M={shape}, lambda_l1={self.lambda_l1}, mu={self.mu}, sum_to_one={self.sum_to_one})"
+
+    def fit(self, M):
+        super().fit(M)
+        self.eigvals, self.eigvecs = np.linalg.eigh(self.G)
+        e = np.maximum(self.eigvals, self.eigvals[-1] * np.finfo(np.float64).eps)
+        self.mu_ = np.sqrt(e[0] * e[-1]) if self.mu is None else self.mu
+        return self
+
+    def _x_update(self, rhs, mu):
+        '''
+        Solves (M^T M + mu I) x = rhs per pixel (projected onto sum(x) = 1 if sum_to_one), mu of shape (N,1).
+        '''
+        X = rhs @ self.eigvecs
+        X /= self.eigvals + mu
+        X = X @ self.eigvecs.T
+        if self.sum_to_one:
+            # F 1 with F = (M^T M + mu I)^-1 per pixel
+            F_1 = (self.eigvecs.sum(axis=0) / (self.eigvals + mu)) @ self.eigvecs.T
+            X -= F_1 * ((X.sum(axis=1, keepdims=True) - 1) / F_1.sum(axis=1, keepdims=True))
+        return X
+
+    def _transform_spectra(self, spectra):
+        c, _ = self.solve(spectra)
+        return c
+
+    def solve(self, spectra):
+        '''
+        Pixels that do not converge within max_iter iterations raise a RuntimeWarning, their abundances are projected onto
+        the constraints (non-negative, and the simplex if sum_to_one).
+        input:
+            spectra: np.array of shape (N,k)
+        output:
+            c: abundances, np.array of shape (N,n)
+            n_iter: number of ADMM iterations per pixel, np.array of shape (N,)
+        '''
+        self._check_fitted()
+        spectra = np.asarray(spectra, dtype=np.float64)
+        B = spectra @ self.M
+        C = np.zeros_like(B)
+        n_iter = np.zeros(B.shape[0], dtype=np.int64)
+        # working arrays only hold the pixels that have not converged yet
+        idx = np.arange(B.shape[0])
+        mu = np.full((B.shape[0], 1), self.mu_)
+        Z = np.maximum(self._x_update(B, mu), 0)
+        D = np.zeros_like(Z)
+        for it in range(1, self.max_iter + 1):
+            Z_old = Z
+            rhs = Z + D
+            rhs *= mu
+            rhs += B
+            X = self._x_update(rhs, mu)
+            Z = X - D
+            Z -= self.lambda_l1 / mu
+            np.maximum(Z, 0, out=Z)
+            D -= X
+            D += Z
+            n_iter[idx] += 1
+            if it % self.check_every and it < self.max_iter:
+                continue
+            # primal residual x - z and dual residual mu (z - z_old), relative to the abundances and the dual variables mu d
+            primal = np.linalg.norm(X - Z, axis=1)
+            dual = mu[:, 0] * np.linalg.norm(Z - Z_old, axis=1)
+            converged = ((primal <= self.tol * np.maximum(np.linalg.norm(Z, axis=1), 1e-12)) &
+                         (dual <= self.tol * np.maximum(mu[:, 0] * np.linalg.norm(D, axis=1), 1e-12)))
+            if converged.any():
+                C[idx[converged]] = Z[converged]
+                keep = ~converged
+                idx, B, Z, D, mu = idx[keep], B[keep], Z[keep], D[keep], mu[keep]
+                primal, dual = primal[keep], dual[keep]
+                if idx.size == 0:
+                    break
+            # residual balancing, the scaled dual variable d changes inversely to mu
+            factor = np.where(primal > 3 * dual, 2.0, np.where(dual > 3 * primal, 0.5, 1.0))[:, None]
+            mu *= factor
+            D /= factor
+        if idx.size:
+            # slow ADMM convergence on ill-conditioned libraries: the support of Z is close to the optimal one,
+            # finish these pixels with the active set method warm-started from it
+            C[idx], _ = nnls_batched(self.M, spectra[idx], sum_to_one=self.sum_to_one, G=self.G, init=Z > 0,
+                                     lambda_l1=self.lambda_l1)
+            warnings.warn(f"ADMM did not converge within {self.max_iter} iterations for {idx.size} of {C.shape[0]} pixels, "
+                          "they were solved with nnls_batched", RuntimeWarning)
+        return C, n_iter
+
+    def _state(self):
+        return {**super()._state(), "lambda_l1": self.lambda_l1, "mu": self.mu_, "sum_to_one": self.sum_to_one,
+                "max_iter": self.max_iter, "tol": self.tol, "check_every": self.check_every,
+                "eigvals": self.eigvals, "eigvecs": self.eigvecs}
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.lambda_l1, self.mu, self.mu_ = float(state["lambda_l1"]), float(state["mu"]), float(state["mu"])
+        self.sum_to_one, self.max_iter, self.tol = bool(state["sum_to_one"]), int(state["max_iter"]), float(state["tol"])
+        self.check_every = int(state["check_every"])
+        self.eigvals, self.eigvecs = state["eigvals"], state["eigvecs"]
+
+
+def load_spectra_library(folder, prefix="m_", names=None):
+    '''
+    Loads simulated endmember spectra (e.g. all variants in mc_sim/spectra_mc) as a library matrix.
+    input:
+        folder: folder with one spectrum per .txt file
+        prefix: file name prefix of the spectra to load, e.g. "m_" for the absorbance-like spectra, "R_" for reflectances
+        names: names of the spectra to load without prefix and extension, default all files with the prefix
+    output:
+        M: library matrix, np.array of shape (k, n)
+        names: names of the columns, list
+    '''
+    if names is None:
+        names = sorted(f[len(prefix):-4] for f in os.listdir(folder) if f.startswith(prefix) and f.endswith(".txt"))
+    M = np.stack([np.loadtxt(os.path.join(folder, prefix + name + ".txt")) for name in names], axis=1)
+    return M, names
+
+
+_UNMIXERS = {cls.__name__: cls for cls in [LSUnmixer, NNLSUnmixer, FCLSUnmixer, OSPUnmixer, SUnSALUnmixer]}
+
+
+def _block_average(abs, factor):
+    '''
+    Averages blocks of factor x factor pixels, the image is padded with its edge pixels to a multiple of factor.
+    '''
+    m, l, k = abs.shape
+    pad = ((0, -m % factor), (0, -l % factor), (0, 0))
+    padded = np.pad(abs, pad, mode="edge")
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor, k).mean(axis=(1, 3))
+
+def _estimate_bound(unmixer, c, spectra):
+    '''
+    Improves candidate abundances with one least squares solve on their passive sets and bounds the remaining distance
+    to the exact solution, see unmix_multiresolution.
+    output:
+        c: the passive set solutions where they are non-negative, the candidates otherwise, np.array of shape (N,n)
+        bound: upper bound of ||c - c_exact|| per pixel, inf where the passive set solution is infeasible, np.array of shape (N,)
+    '''
+    B = np.asarray(spectra, dtype=np.float64) @ unmixer.M
+    P = c > 0
+    S, nu = _solve_passive(unmixer.G, B, P, unmixer.factors, unmixer.sum_to_one)
+    W = B - S @ unmixer.G - nu[:, None]
+    feasible = (S >= 0).all(axis=1)
+    # the objective is strongly convex with modulus lambda_min(G) and its gradient vanishes on the passive set,
+    # so lambda_min(G) ||S - c_exact||^2 <= sum over the other endmembers of max(w_i, 0) c_exact_i <= ||w+|| ||S - c_exact||
+    bound = np.linalg.norm(np.where(P, 0, np.maximum(W, 0)), axis=1) / np.linalg.eigvalsh(unmixer.G)[0]
+    return np.where(feasible[:, None], S, c), np.where(feasible, bound, np.inf)
+
+def unmix_multiresolution(unmixer, abs, levels=3, factor=2, threshold=1e-3, tol=None, callback=None):
+    '''
+    Coarse-to-fine unmixing on a block-average pyramid of the cube. The coarsest level is solved completely and the
+    abundances of every level are upsampled as initial guesses for the next finer one. Every guess is replaced by the least
+    squares solution on its passive set if that is non-negative (one batched solve, exact if the passive set is right), and
+    only pixels whose distance to the exact abundances may exceed threshold are re-solved, warm-started with the passive set
+    of the guess and to the full accuracy of nnls_batched.
+    The distance is bounded with the strong convexity of the objective: ||c - c_exact|| <= ||w+|| / lambda_min(M^T M), where
+    w+ are the positive gradient components of the endmembers outside the passive set. Every pixel of the result is within
+    its returned bound <= threshold of NNLSUnmixer/FCLSUnmixer.abundances, threshold=0 gives the full solve.
+    input:
+        unmixer: fitted NNLSUnmixer or FCLSUnmixer
+        abs: absorbance cube, np.array of shape (m,l,k)
+        levels: number of pyramid levels including the full resolution, int
+        factor: block size of the averaging between two levels, int
+        threshold: largest accepted distance ||c - c_exact|| of a pixel that is not re-solved, in abundance units, float
+        tol: gradient tolerance of nnls_batched for the re-solved pixels (optional)
+        callback: called as callback(level, c) after every level for previews, level 0 is the full resolution (optional)
+    output:
+        c: estimated abundances, np.array of shape (m,l,n)
+        bound: upper bound of ||c - c_exact|| per pixel, zero for re-solved pixels, np.array of shape (m,l)
+        n_solved: number of pixels solved per level, coarsest level first, list
+    '''
+    if not isinstance(unmixer, NNLSUnmixer):
+        raise ValueError("unmix_multiresolution needs an NNLSUnmixer or FCLSUnmixer")
+    unmixer._check_fitted()
+    pyramid = [np.asarray(abs)]
+    for _ in range(levels - 1):
+        pyramid.append(_block_average(pyramid[-1], factor))
+    c = unmixer.abundances(pyramid[-1])
+    bound = np.zeros(c.shape[:2])
+    n_solved = [c.shape[0] * c.shape[1]]
+    if callback is not None:
+        callback(levels - 1, c)
+    for level in range(levels - 2, -1, -1):
+        cube = pyramid[level]
+        m, l, k = cube.shape
+        # contiguous copy, so guess below is a view of c and the re-solved pixels end up in c
+        c = np.ascontiguousarray(np.repeat(np.repeat(c, factor, axis=0), factor, axis=1)[:m, :l])
+        spectra = cube.reshape(-1, k)
+        guess = c.reshape(-1, c.shape[-1])
+        bound = np.zeros(m * l)
+        for start in range(0, spectra.shape[0], unmixer.chunk_size):
+            chunk = slice(start, start + unmixer.chunk_size)
+            guess[chunk], bound[chunk] = _estimate_bound(unmixer, guess[chunk], spectra[chunk])
+        resolve = np.flatnonzero(bound > threshold)
+        for start in range(0, resolve.size, unmixer.chunk_size):
+            idx = resolve[start:start+unmixer.chunk_size]
+            guess[idx], _ = nnls_batched(unmixer.M, spectra[idx], tol=tol, sum_to_one=unmixer.sum_to_one, G=unmixer.G,
+                                         factors=unmixer.factors, init=guess[idx] > 0)
+        bound[resolve] = 0
+        bound = bound.reshape(m, l)
+        n_solved.append(resolve.size)
+        if callback is not None:
+            callback(level, c)
+    return c, bound, n_solved
+
+def quantize_spectra(spectra, step):
+    '''
+    Groups spectra (or any coordinates) that fall into the same cell of a grid with spacing step in every band.
+    input:
+        spectra: np.array of shape (N,k)
+        step: grid spacing in absorbance units, float
+    output:
+        representatives: mean spectrum of every group, np.array of shape (u,k)
+        index: group of every spectrum, np.array of shape (N,)
+    '''
+    q = np.ascontiguousarray(np.floor(spectra / step).astype(np.int32))
+    rows = q.view(np.dtype((np.void, q.dtype.itemsize * q.shape[1]))).ravel()
+    _, index = np.unique(rows, return_inverse=True)
+    index = index.ravel()
+    n_groups = index.max() + 1 if index.size else 0
+    groups = scipy.sparse.csr_matrix((np.ones(index.size), (index, np.arange(index.size))), shape=(n_groups, index.size))
+    counts = np.asarray(groups.sum(axis=1)).ravel()
+    representatives = (groups @ spectra.astype(np.float64)) / counts[:, None]
+    return representatives, index
+
+def lipschitz_constant(unmixer):
+    '''
+    Bound L with ||c(y1) - c(y2)|| <= L ||y1 - y2|| for the abundances of a fitted unmixer.
+    For least squares over any convex set (unconstrained, non-negative, fully constrained) the solution is a projection
+    in the norm ||M x||, so L = 1/sigma_min(M); for OSP it is the spectral norm of the filter matrix.
+    '''
+    unmixer._check_fitted()
+    if isinstance(unmixer, OSPUnmixer):
+        return np.linalg.norm(unmixer.W, 2)
+    return 1 / np.linalg.svd(unmixer.M, compute_uv=False).min()
+
+def unmix_deduplicated(unmixer, abs, step=1e-3):
+    '''
+    Unmixing with a deduplication pre-pass. The abundances only depend on the part of a spectrum in the span of the
+    endmembers, so the spectra are reduced to their n coordinates z = Q^T y in an orthonormal basis Q of that span
+    and quantized there with spacing step. Only the mean of every occupied cell is solved and the abundances are
+    scattered back to the pixels through the index map. Background, specular and saturated pixels collapse to few
+    cells, so the number of solves drops by a large factor.
+    The deviation from the exact per-pixel solution is bounded by lipschitz_constant(unmixer) * ||z - z_representative||,
+    which is returned per pixel.
+    input:
+        unmixer: fitted Unmixer
+        abs: absorbance spectra, np.array of shape (...,k)
+        step: grid spacing of the coordinates in absorbance units, float
+    output:
+        c: estimated abundances (heatmaps for OSPUnmixer), np.array of shape (...,n)
+        err: difference spectrum of the pixels (None for OSPUnmixer), np.array of shape (...,k)
+        bound: upper bound of ||c - c_exact|| per pixel, np.array of shape (...)
+        n_solved: number of representatives that were solved, int
+    '''
+    unmixer._check_fitted()
+    spectra = abs.reshape(-1, abs.shape[-1])
+    Q, _ = np.linalg.qr(unmixer.M)
+    z = spectra @ Q
+    representatives, index = quantize_spectra(z, step)
+    c = unmixer.abundances(representatives @ Q.T)[index]
+    bound = lipschitz_constant(unmixer) * np.linalg.norm(z - representatives[index], axis=-1)
+    c = c.reshape(abs.shape[:-1] + (c.shape[-1],))
+    err = None
+    if not isinstance(unmixer, OSPUnmixer):
+        err = np.einsum("kn,...n->...k", unmixer.M, c) - abs
+    return c, err, bound.reshape(abs.shape[:-1]), len(representatives)
+
+def _unmix_tile(unmixer, tile, residual):
+    '''
+    Abundances and selected residual of one tile.
+    '''
+    c_tile = unmixer.abundances(tile)
+    if residual is None:
+        return c_tile, None
+    err_tile = np.einsum("kn,...n->...k", unmixer.M, c_tile) - tile
+    if residual == "norm":
+        err_tile = np.linalg.norm(err_tile, axis=-1)
+    return c_tile, err_tile
+
+def _share(arr, path=None):
+    '''
+    Makes an array available to worker processes without pickling it: .npy files given by path are memory-mapped
+    by the workers, other arrays are copied once into a shared memory block.
+    output:
+        descriptor passed to the workers, shared memory block to release after the run (None for .npy files)
+    '''
+    if path is not None:
+        return ("npy", path), None
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return ("shm", shm.name, arr.shape, arr.dtype.str), shm
+
+def _shared_output(out, shape):
+    '''
+    Output array the workers write into: a memory-mapped .npy file if out is a path, otherwise a shared memory block.
+    output:
+        array in the main process, descriptor passed to the workers, shared memory block (None for .npy files)
+    '''
+    if isinstance(out, str):
+        arr = _open_output(out, shape)
+        return arr, ("npy", out), None
+    # preallocated outputs keep their dtype, so e.g. float64 results are not rounded to float32 on the way
+    dtype = np.dtype(np.float32) if out is None else _open_output(out, shape).dtype
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return arr, ("shm", shm.name, shape, dtype.str), shm
+
+_WORKER = {}
+
+def _attach(desc, mode="r+"):
+    if desc is None:
+        return None
+    if desc[0] == "npy":
+        return np.load(desc[1], mmap_mode=mode)
+    _, name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    # keep the block open as long as the worker lives
+    _WORKER.setdefault("shm", []).append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _init_worker(unmixer, abs_desc, c_desc, err_desc, residual):
+    _WORKER.update(unmixer=unmixer, abs=_attach(abs_desc, "r"), c=_attach(c_desc), err=_attach(err_desc), residual=residual)
+
+def _read_rows(abs, r0, r1):
+    '''
+    Rows r0 to r1-1 of a cube, arrays keep their dtype so the result does not depend on the tiling, SpyFiles are read as float32.
+    '''
+    if isinstance(abs, np.ndarray):
+        return abs[r0:r1]
+    return get_array(abs, rows=(r0, r1))
+
+def _unmix_rows(r0, r1):
+    c_tile, err_tile = _unmix_tile(_WORKER["unmixer"], _read_rows(_WORKER["abs"], r0, r1), _WORKER["residual"])
+    _WORKER["c"][r0:r1] = c_tile
+    if err_tile is not None:
+        _WORKER["err"][r0:r1] = err_tile
+
+def unmix_tiled(unmixer, abs, out=None, residual="norm", residual_out=None, tile_rows=32, workers=1):
+    '''
+    Streaming unmixing of a cube in row tiles with a fitted unmixer, so memory stays bounded by one tile
+    regardless of the image size when input and outputs are memory-mapped.
+    With workers > 1 the tiles are distributed over a process pool. The workers read the cube from its memory-mapped
+    .npy file or a shared memory copy and write into shared outputs, only the row bounds of a tile are sent to them.
+    input:
+        unmixer: fitted Unmixer
+        abs: absorbance cube of shape (m,l,k): array, np.memmap, path of a .npy file (opened memory-mapped) or SpyFile
+        out: None, path of a .npy file to memory-map, or preallocated array of shape (m,l,n) for the abundances (float32 if new)
+        residual: "full" for the difference spectrum (m,l,k), "norm" for its per-pixel L2 norm (m,l), or None
+        residual_out: None, path of a .npy file to memory-map, or preallocated float32 array for the residual
+        tile_rows: number of rows per tile, int
+        workers: number of worker processes, int
+    output:
+        c: estimated abundances, np.array (or np.memmap) of shape (m,l,n)
+        err: residual as selected, None if residual is None
+    '''
+    if residual not in ("full", "norm", None):
+        raise ValueError(f"Unknown residual {residual}")
+    if residual is not None and isinstance(unmixer, OSPUnmixer):
+        raise ValueError("OSPUnmixer returns heatmaps, use residual=None")
+    unmixer._check_fitted()
+    abs_path = None
+    if isinstance(abs, str):
+        abs_path = abs
+        abs = np.load(abs, mmap_mode="r")
+    m, l, k = abs.shape
+    c_shape = (m, l, unmixer.M.shape[1])
+    err_shape = {"full": (m, l, k), "norm": (m, l), None: None}[residual]
+
+    if workers > 1:
+        c, err = _unmix_parallel(unmixer, abs, abs_path, out, residual, residual_out, tile_rows, workers, c_shape, err_shape)
+    else:
+        c = _open_output(out, c_shape)
+        err = None if residual is None else _open_output(residual_out, err_shape)
+        for r0, r1 in _row_tiles(m, tile_rows):
+            c[r0:r1], err_tile = _unmix_tile(unmixer, _read_rows(abs, r0, r1), residual)
+            if err_tile is not None:
+                err[r0:r1] = err_tile
+    for arr in (c, err):
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    return c, err
+
+def _unmix_parallel(unmixer, abs, abs_path, out, residual, residual_out, tile_rows, workers, c_shape, err_shape):
+    '''
+    Process pool part of unmix_tiled.
+    '''
+    if abs_path is None and not isinstance(abs, np.ndarray):
+        # SpyFiles can not be shared, load the cube once
+        abs = get_array(abs)
+    blocks = []
+    try:
+        abs_desc, shm = _share(abs, abs_path)
+        blocks.append(shm)
+        c, c_desc, shm = _shared_output(out, c_shape)
+        blocks.append(shm)
+        err, err_desc = None, None
+        if residual is not None:
+            err, err_desc, shm = _shared_output(residual_out, err_shape)
+            blocks.append(shm)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(unmixer, abs_desc, c_desc, err_desc, residual)) as executor:
+            tiles = list(_row_tiles(c_shape[0], tile_rows))
+            list(executor.map(_unmix_rows, [r0 for r0, _ in tiles], [r1 for _, r1 in tiles]))
+        # results in shared memory are copied out before the blocks are released (or into the preallocated outputs)
+        if c_desc[0] == "shm":
+            c = _copy_out(c, out)
+        if err_desc is not None and err_desc[0] == "shm":
+            err = _copy_out(err, residual_out)
+    finally:
+        for shm in blocks:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+    return c, err
+
+def _parallel_tile_rows(n_rows, chunk_size, workers):
+    '''
+    Rows per tile so that every worker gets several tiles, but no tile is larger than chunk_size rows.
+    '''
+    return max(1, min(chunk_size, -(-n_rows // (4 * workers))))
+
+def _copy_out(shared, out):
+    if out is None:
+        return shared.copy()
+    out[...] = shared
+    return out
+
+
 class FCLSU:
     '''
     Fully Constrained Least Squares Unmixing (https://github.com/BehnoodRasti/Unmixing_Tutorial_IEEE_IADF/blob/main/VCA_FCLSU.ipynb)
     '''
-    def __init__(self):
-        pass
+    def __init__(self, method="batched", chunk_size=65536, workers=1):
+        '''
+        input:
+            method: "batched" solves all pixels of a chunk together with nnls_batched, "cvxopt" solves one QP per pixel
+            chunk_size: number of pixels solved at once by the batched solver
+            workers: number of worker processes for the batched solver, see unmix_tiled
+        '''
+        if method not in ("batched", "cvxopt"):
+            raise ValueError(f"Unknown method {method}")
+        self.method = method
+        self.chunk_size = chunk_size
+        self.workers = workers
 
     def __repr__(self):
-        msg = f"{self.__class__.__name__}"
+        msg = f"{self.__class__.__name__}(method={self.method!r}, chunk_size={self.chunk_size}, workers={self.workers})"
         return msg
 
     @staticmethod
@@ -81,12 +1043,12 @@ class FCLSU:
         is least squares with the abundance sum-to-one constraint (ASC) and the
         abundance nonnegative constraint (ANC).
         Parameters:
-            Y: `numpy array`
+            Y: `numpy array` or CPU `torch tensor`
                 2D data matrix (L x N).
-            E: `numpy array`
+            E: `numpy array` or CPU `torch tensor`
                 2D matrix of endmembers (L x p).
         Returns:
-            X: `numpy array`
+            X: `numpy array` (`torch tensor` if Y is a tensor)
                 2D abundance maps (p x N).
         References:
             Daniel Heinz, Chein-I Chang, and Mark L.G. Fully Constrained
@@ -100,17 +1062,46 @@ class FCLSU:
                 http://maggotroot.blogspot.ca/2013/11/constrained-linear-least-squares-in.html
                 , it's great code.
         """
+        is_torch = _is_torch(Y)
+        Y, E = _to_numpy(Y), _to_numpy(E)
         assert len(Y.shape) == 2
         assert len(E.shape) == 2
 
-        print(Y.shape)
-        print(E.shape)
-
         L1, N = Y.shape
         L2, p = E.shape
 
         assert L1 == L2
 
+        if self.method == "batched":
+            X = self._solve_batched(Y, E)
+        else:
+            X = self._solve_cvxopt(Y, E)
+        return torch.from_numpy(X.T) if is_torch else X.T
+
+    def _solve_batched(self, Y, E):
+        '''
+        Solves all pixels chunk-wise with nnls_batched and the sum-to-one constraint,
+        the inverses of the endmember sub Gram matrices are shared by all pixels of a chunk.
+        output:
+            X: abundances (N x p)
+        '''
+        unmixer = FCLSUnmixer(self.chunk_size).fit(E)
+        if self.workers > 1:
+            N = Y.shape[1]
+            c, _ = unmix_tiled(unmixer, Y.T[:, None, :], residual=None,
+                               tile_rows=_parallel_tile_rows(N, self.chunk_size, self.workers), workers=self.workers)
+            return c[:, 0, :]
+        return unmixer.abundances(Y.T).astype(np.float32)
+
+    def _solve_cvxopt(self, Y, E):
+        '''
+        Solves one cvxopt QP per pixel.
+        output:
+            X: abundances (N x p)
+        '''
+        L1, N = Y.shape
+        L2, p = E.shape
+
         # Reshape to match implementation
         M = np.copy(Y.T)
         U = np.copy(E.T)
@@ -140,7 +1131,7 @@ class FCLSU:
             q = -d.T * C
             sol = solvers.qp(Q, q.T, A, b, Aeq, beq, None, None)["x"]
             X[n1] = np.array(sol).squeeze()
-        return X.T
+        return X
 
     def solve_FCLSU_2d(self, abs, M):
         '''
@@ -148,13 +1139,19 @@ class FCLSU:
         input: 
             abs: 3d array, hyperspectral image absorption where the last dimension is the spectral dimension
             M: 2d array of endmembers, where the first dimension is the spectral dimension
+            (numpy arrays or CPU torch tensors)
         output:
             c: 3d array, abundance maps of the endmembers
+            err: 3d array, difference spectrum
         '''
+        is_torch = _is_torch(abs)
+        abs, M = _to_numpy(abs), _to_numpy(M)
         m, l, k = abs.shape
         n = M.shape[1]
         Y = abs.reshape(-1, abs.shape[-1]).T  # (k, ml)
         c = self.solve_FCLSU(Y, M).T # (ml, n)
         c = c.reshape(m,l,n)  # (m, l, n)
         err = np.einsum("kn,mln->mlk", M, c) - abs
-        return c, err
\ No newline at end of file
+        if is_torch:
+            return torch.from_numpy(c), torch.from_numpy(err)
+        return c, err